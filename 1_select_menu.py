@@ -1,12 +1,12 @@
-from PIL import Image
 import ui
 import scene
 import os
 import shutil
 import dialogs
-import json
 from draw import MyScene
-from my_funcs import pil2ui
+from mym.index import (
+	load_index, save_index, refresh, update_project, copy_project,
+	remove_project, rename_project, thumb_path)
 FOLDERS = "files/save_data"
 latest = 'latest.txt'
 
@@ -24,6 +24,7 @@ def num_folder(name):
 	return f'{name} {num}'
 
 v = None
+index = None
 dirs = {}
 cur_key = None
 next_key = 0
@@ -59,18 +60,12 @@ def new_dir(sender):
 		dialogs.hud_alert("Existing", 'error', 1)
 		return
 	
-	lays = Image.open(os.path.join(path, 'layers.png'))
-	with open(os.path.join(path, 'data.json')) as f:
-		data = json.load(f)
-	lay_dict = data["layers"]["0"]
-	y = lay_dict["y"]
-	w = lay_dict["w"]
-	h = lay_dict["h"]
-	img = lays.transform((w, h), Image.EXTENT, (0, y, w, y + h))
+	update_project(index, FOLDERS, name)
+	save_index(index)
 	
 	length = len(dirs)
 	dirs[next_key] = (name, length)
-	add_view(next_key, length, img)
+	add_view(next_key, length)
 	next_key += 1
 	
 
@@ -87,19 +82,12 @@ def copy_dir(sender):
 	path = os.path.join(FOLDERS, name)
 	new_name = num_folder(name)
 	shutil.copytree(path, os.path.join(FOLDERS, new_name))
-	
-	lays = Image.open(os.path.join(path, 'layers.png'))
-	with open(os.path.join(path, 'data.json')) as f:
-		data = json.load(f)
-	lay_dict = data["layers"]["0"]
-	y = lay_dict["y"]
-	w = lay_dict["w"]
-	h = lay_dict["h"]
-	img = lays.transform((w, h), Image.EXTENT, (0, y, w, y + h))
+	copy_project(index, FOLDERS, name, new_name)
+	save_index(index)
 	
 	length = len(dirs)
 	dirs[next_key] = (new_name, length)
-	add_view(next_key, length, img)
+	add_view(next_key, length)
 	next_key += 1
 	
 
@@ -116,6 +104,8 @@ def delete_dir(sender):
 	num = dirs[cur_key][1]
 	
 	shutil.rmtree(os.path.join(FOLDERS, dirs[cur_key][0]))
+	remove_project(index, dirs[cur_key][0])
+	save_index(index)
 	del dirs[cur_key]
 	img_v = scroll[f'img_{cur_key}']
 	bt_v = scroll[f'dir_{cur_key}']
@@ -146,6 +136,8 @@ def rename_dir(sender):
 	except OSError:
 		dialogs.hud_alert("Existing", 'error', 1)
 		return
+	rename_project(index, old_name, new_name)
+	save_index(index)
 	
 	dirs[cur_key] = (new_name, dirs[cur_key][1])
 	bt_v = v['scroll'][f'dir_{cur_key}']
@@ -166,12 +158,21 @@ def select_dir(sender):
 	sender.border_color = '#77ff55'
 	
 
-def add_view(key, num, img):
+def thumb_image(name):
+	"""索引のサムネイル (ui.Image.named はキャッシュするので使わない)"""
+	try:
+		with open(thumb_path(FOLDERS, name), 'rb') as f:
+			return ui.Image.from_data(f.read())
+	except OSError:
+		return None
+
+
+def add_view(key, num):
 	length = len(dirs)
 	scroll = v['scroll']
 	scroll.content_size = (320, max(320, length * 80 + 16))
 	
-	ui_img = pil2ui(img)
+	ui_img = thumb_image(dirs[key][0])
 	y = num * 80 + 16
 	
 	img_v = ui.ImageView()
@@ -191,9 +192,14 @@ def add_view(key, num, img):
 
 
 def load_ui():
-	global v, dirs, cur_key, next_key
+	global v, index, dirs, cur_key, next_key
 	
-	dir_list = os.listdir(FOLDERS)
+	# 変わったプロジェクトだけサムネイルを作り直す
+	index = load_index()
+	if refresh(index, FOLDERS):
+		save_index(index)
+	
+	dir_list = list(index['projects'])
 	dir_list.sort()
 	length = len(dir_list)
 	ranlen = range(length)
@@ -205,19 +211,7 @@ def load_ui():
 	v = ui.load_view()
 	
 	for key, value in dirs.items():
-		path = value[0]
-		
-		lays = Image.open(os.path.join(FOLDERS, path, 'layers.png'))
-		with open(os.path.join(FOLDERS, path, 'data.json')) as f:
-			data = json.load(f)
-		lay_dict = data["layers"]["0"]
-		
-		y = lay_dict["y"]
-		w = lay_dict["w"]
-		h = lay_dict["h"]
-		img = lays.transform((w, h), Image.EXTENT, (0, y, w, y + h))
-		
-		add_view(key, value[1], img)
+		add_view(key, value[1])
 	
 	v.corner_radius = 10
 	v.border_color = '#6699cc'
@@ -0,0 +1,37 @@
+import console
+import os
+
+from mym.container import (
+	EXTENSION, container_to_folder, folder_to_container)
+
+FOLDERS = 'files/save_data'
+CONTAINERS = 'files/containers'
+
+
+# files/save_data のフォルダ <-> files/containers の .px3
+c = console.alert('Convert', '', 'folder -> px3', 'px3 -> folder')
+os.makedirs(CONTAINERS, exist_ok=True)
+if c == 1:
+	for name in sorted(os.listdir(FOLDERS)):
+		folder = os.path.join(FOLDERS, name)
+		if os.path.isdir(folder):
+			missing = folder_to_container(folder, os.path.join(CONTAINERS, name + EXTENSION))
+			if missing:
+				# 見つからないレイヤーは透明なまま入る
+				print(f'{name}: {missing} layer(s) missing')
+			else:
+				print(name)
+else:
+	for name in sorted(os.listdir(CONTAINERS)):
+		if name.endswith(EXTENSION):
+			folder = os.path.join(FOLDERS, name[:-len(EXTENSION)])
+			if os.path.exists(folder):
+				# 上書きすると、そのフォルダの undo 履歴は使えなくなる
+				c = console.alert(
+					'Overwrite', f'{folder} exists. Its undo history will be lost.',
+					'Overwrite', 'Skip', hide_cancel_button=True)
+				if c != 1:
+					print(f'{name}: skipped')
+					continue
+			container_to_folder(os.path.join(CONTAINERS, name), folder)
+			print(name)
@@ -0,0 +1,136 @@
+"""
+プロジェクトの保存形式の比較 (Pythonista なしで実行可)
+	python -m bench.container [レイヤー数] [画像サイズ]
+layers.png (縦に並べた1枚), レイヤーごとの PNG, .px3 (zlib / raw)
+行き来しても画像が変わらないことも確かめる
+"""
+from PIL import Image, ImageDraw
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from mym.container import RAW, ZLIB, Container, save
+from mym.project import (
+	STACKED, layer_file, load_layers, write_project)
+
+
+def project(layers, size, rnd):
+	"""ドット絵らしく、少ない色の四角を重ねたレイヤー"""
+	colors = [tuple(rnd.randrange(256) for _ in range(3)) + (255,) for _ in range(16)]
+	images = {}
+	for key in range(layers):
+		img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+		draw = ImageDraw.Draw(img)
+		for _ in range(64):
+			x, y = rnd.randrange(size), rnd.randrange(size)
+			w, h = rnd.randrange(1, size // 4), rnd.randrange(1, size // 4)
+			draw.rectangle((x, y, x + w, y + h), fill=rnd.choice(colors))
+		images[key] = img
+	data = {
+		"selected": 0, "next_key": layers,
+		"layers": {
+			key: {"w": size, "h": size, "a": 1.0, "n": key} for key in images},
+		"palette": dict(enumerate(colors[:8]))}
+	return json.loads(json.dumps(data)), images
+
+
+def save_stacked(folder, data, images):
+	"""以前の stop() と同じ書き方"""
+	w = max(img.size[0] for img in images.values())
+	h = sum(img.size[1] for img in images.values())
+	stacked = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+	y = 0
+	data = json.loads(json.dumps(data))
+	for k, lay_dict in data["layers"].items():
+		img = images[int(k)]
+		stacked.paste(img, (0, y))
+		lay_dict["y"] = y
+		y += img.size[1]
+	stacked.save(os.path.join(folder, STACKED), "png")
+	with open(os.path.join(folder, "data.json"), "w") as f:
+		json.dump(data, f)
+
+
+def save_layers(folder, data, images):
+	data = json.loads(json.dumps(data))
+	files = {}
+	for k, lay_dict in data["layers"].items():
+		lay_dict["file"] = layer_file(k, 1)
+		files[lay_dict["file"]] = images[int(k)]
+	write_project(folder, files, data)
+
+
+def load_folder(folder):
+	with open(os.path.join(folder, "data.json")) as f:
+		data = json.load(f)
+	return load_layers(folder, data)[0]
+
+
+def load_container(path):
+	with Container(path) as c:
+		return c.images()
+
+
+def load_one(path):
+	"""1枚だけ読む (開いたときの選択中のレイヤー)"""
+	with Container(path) as c:
+		return {0: c.image(0)}
+
+
+def size_of(path):
+	if os.path.isfile(path):
+		return os.path.getsize(path)
+	total = 0
+	for root, _, files in os.walk(path):
+		total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+	return total
+
+
+def timed(func):
+	start = time.perf_counter()
+	result = func()
+	return time.perf_counter() - start, result
+
+
+def main(layers=64, size=256):
+	rnd = random.Random(0)
+	data, images = project(layers, size, rnd)
+	expect = {key: img.tobytes() for key, img in images.items()}
+	tmp = tempfile.mkdtemp()
+
+	cases = []
+	stacked = os.path.join(tmp, "stacked")
+	os.mkdir(stacked)
+	cases.append(("layers.png", stacked, lambda: save_stacked(stacked, data, images), lambda: load_folder(stacked)))
+	per_layer = os.path.join(tmp, "per_layer")
+	os.mkdir(per_layer)
+	cases.append(("per layer", per_layer, lambda: save_layers(per_layer, data, images), lambda: load_folder(per_layer)))
+	for codec in (ZLIB, RAW):
+		path = os.path.join(tmp, f"project_{codec}.px3")
+		cases.append((
+			f"px3 {codec}", path,
+			lambda path=path, codec=codec: save(path, data, images, codec),
+			lambda path=path: load_container(path)))
+
+	print(f"{layers} layers, {size}x{size}")
+	print("".rjust(12), "save".rjust(10), "load".rjust(10), "size".rjust(10))
+	for name, path, save_func, load_func in cases:
+		t_save, _ = timed(save_func)
+		t_load, loaded = timed(load_func)
+		assert {key: img.tobytes() for key, img in loaded.items()} == expect, name
+		print(
+			name.rjust(12), f"{t_save * 1000:8.1f}ms", f"{t_load * 1000:8.1f}ms",
+			f"{size_of(path) / 1024:8.1f}K")
+
+	for codec in (ZLIB, RAW):
+		path = os.path.join(tmp, f"project_{codec}.px3")
+		t_one, loaded = timed(lambda: load_one(path))
+		assert loaded[0].tobytes() == expect[0]
+		print(f"  px3 {codec} 1 layer {t_one * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+	main(*(int(v) for v in sys.argv[1:3]))
@@ -0,0 +1,187 @@
+"""
+履歴 (mym.history) の undo/redo 1回あたりの時間 (Pythonista なしで実行可)
+	python -m bench.history [レイヤー数] [画像サイズ]
+結果が元に戻ることも確かめる
+"""
+from PIL import Image, ImageDraw
+import hashlib
+import random
+import sys
+import time
+
+from mym.history import (
+	AddLayer, Clear, Document, Extent, History, ImageReplace, MoveLayer,
+	PixelDiff, RemoveLayer, payload_nbytes)
+
+
+def snapshot(doc):
+	return [(key, doc.layers[key].image.tobytes()) for key in doc.order]
+
+
+def digest(doc):
+	h = hashlib.md5()
+	for key, data in snapshot(doc):
+		h.update(str(key).encode())
+		h.update(data)
+	return h.digest()
+
+
+def stroke(img, rnd):
+	"""線を1本引いた画像と、変わった範囲"""
+	w, h = img.size
+	points = [(rnd.randrange(w), rnd.randrange(h)) for _ in range(2)]
+	x0 = min(p[0] for p in points)
+	y0 = min(p[1] for p in points)
+	x1 = max(p[0] for p in points) + 1
+	y1 = max(p[1] for p in points) + 1
+	region = img.crop((x0, y0, x1, y1))
+	color = tuple(rnd.randrange(256) for _ in range(4))
+	ImageDraw.Draw(region).line(
+		[(x - x0, y - y0) for x, y in points], color)
+	return region, (x0, y0, x1, y1)
+
+
+def build(layers, size, rnd):
+	doc = Document()
+	for key in range(layers):
+		data = bytes(rnd.randrange(256) for _ in range(64)) * (size * size * 4 // 64)
+		doc.insert(key, key, Image.frombytes("RGBA", (size, size), data))
+	return doc
+
+
+def timed(func, n):
+	start = time.perf_counter()
+	for _ in range(n):
+		func()
+	return (time.perf_counter() - start) / n
+
+
+def main(layers=32, size=256, steps=200):
+	rnd = random.Random(0)
+	doc = build(layers, size, rnd)
+	history = History()
+	next_key = layers
+	first = snapshot(doc)
+
+	# 記録する側 (ツールと同じ手順)
+	t_record = 0
+	for i in range(steps):
+		kind = i % 10
+		if kind < 7:
+			key = rnd.choice(doc.order)
+			img = doc.layers[key].image
+			region, box = stroke(img, rnd)
+			start = time.perf_counter()
+			cmd = PixelDiff.from_images(key, img, region, box)
+			if cmd is not None:
+				img.paste(region, box)
+				doc.changed(key, box)
+			t_record += time.perf_counter() - start
+			if cmd is None:
+				continue
+			history.push(cmd)
+			continue
+		if kind == 7:
+			key = rnd.choice(doc.order)
+			img = doc.layers[key].image
+			if i % 3 == 0:
+				cmd = ImageReplace.from_images(key, img, Image.new("RGBA", (size, size), (i % 256, 0, 0, 255)))
+			elif i % 3 == 1:
+				x, y = rnd.randrange(-8, 8), rnd.randrange(-8, 8)
+				cmd = Extent.from_image(key, img, (x, y, x + size, y + size))
+			else:
+				cmd = Clear.from_image(key, img)
+			if cmd is None:
+				continue
+		elif kind == 8:
+			# GIF の読み込みと同じく、何枚かまとめて1回の undo にする
+			number = rnd.randrange(len(doc.order) + 1)
+			history.begin()
+			doc.begin()
+			for index in range(rnd.randrange(1, 5)):
+				cmd = AddLayer(next_key, number + index, image=Image.new("RGBA", (size, size), (0, index, 0, 255)))
+				next_key += 1
+				history.push(cmd)
+				cmd.apply(doc)
+			history.commit()
+			doc.end()
+			continue
+		elif len(doc.order) > 1 and rnd.random() < 0.5:
+			key = rnd.choice(doc.order)
+			lay = doc.layers[key]
+			cmd = RemoveLayer(key, lay.number, image=lay.image)
+		else:
+			key = rnd.choice(doc.order)
+			cmd = MoveLayer(key, doc.layers[key].number, target=rnd.randrange(len(doc.order)))
+		history.push(cmd)
+		cmd.apply(doc)
+	last = snapshot(doc)
+
+	# 全部戻して全部やり直す
+	n = history.index + 1
+	t_undo = timed(lambda: history.undo().revert(doc), n)
+	assert snapshot(doc) == first
+	t_redo = timed(lambda: history.redo().apply(doc), n)
+	assert snapshot(doc) == last
+	for key in doc.order:
+		assert doc.layers[key].number == doc.order.index(key)
+
+	print(f"{layers} layers, {size}x{size}, {n} steps")
+	print(f"  record sub  {t_record / (steps * 0.7) * 1000:8.3f} ms")
+	print(f"  undo        {t_undo * 1000:8.3f} ms / step")
+	print(f"  redo        {t_redo * 1000:8.3f} ms / step")
+	print(f"  history     {history.nbytes / 1024:8.1f} KiB")
+
+	jumps(rnd)
+
+	# 大きい画像の端を 16px 切り落とすときに持つ量
+	img = build(1, 1024, rnd).layers[0].image
+	box = (16, 16, 1024 - 16, 1024 - 16)
+	replace = ImageReplace.from_images(0, img, img.crop(box))
+	extent = Extent.from_image(0, img, box)
+	print(f"  crop 1024   image {payload_nbytes(replace.image) / 1024:8.1f} KiB"
+		f" / extent {payload_nbytes(extent.image) / 1024:8.1f} KiB")
+
+
+def jumps(rnd, size=1024, steps=200, back=80):
+	"""線だけの履歴で、back 件前へ1件ずつ戻す場合と jump の比較"""
+	doc = build(2, size, rnd)
+	history = History()
+	states = [digest(doc)]
+	for _ in range(steps):
+		key = rnd.choice(doc.order)
+		img = doc.layers[key].image
+		region, box = stroke(img, rnd)
+		cmd = PixelDiff.from_images(key, img, region, box)
+		if cmd is None:
+			continue
+		# 控えを取ってから書き換える (draw.py の push_command と同じ順)
+		history.keyframe(doc)
+		history.push(cmd)
+		doc.layers[key].own().paste(region, box)
+		states.append(digest(doc))
+	end = history.index
+	target = end - back
+
+	def step():
+		while history.index > target:
+			history.undo().revert(doc)
+		while history.index < end:
+			history.redo().apply(doc)
+	t_step = timed(step, 1) / 2
+	assert digest(doc) == states[end + 1]
+
+	start = time.perf_counter()
+	history.jump(doc, target)
+	t_jump = time.perf_counter() - start
+	assert digest(doc) == states[target + 1]
+	history.jump(doc, end)
+	assert digest(doc) == states[end + 1]
+	for i in (0, -1, end // 2, end):
+		history.jump(doc, i)
+		assert digest(doc) == states[i + 1]
+	print(f"  {back} back on {size}x{size}  step {t_step * 1000:8.3f} ms / jump {t_jump * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+	main(*(int(v) for v in sys.argv[1:3]))
@@ -0,0 +1,84 @@
+"""
+プロジェクト一覧を開くときの時間 (Pythonista なしで実行可)
+	python -m bench.index [プロジェクト数] [画像サイズ]
+全部の data.json と一番下のレイヤーを読む場合と、索引 (mym.index) の比較
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from mym.index import THUMB_SIZE, load_index, refresh, save_index, thumb_path
+from mym.project import bottom_image
+
+from .container import project, save_layers
+
+
+def read_all(folders):
+	"""以前の load_ui と同じ読み方"""
+	images = {}
+	for name in sorted(os.listdir(folders)):
+		folder = os.path.join(folders, name)
+		with open(os.path.join(folder, "data.json")) as f:
+			data = json.load(f)
+		images[name] = bottom_image(folder, data)
+	return images
+
+
+def timed(func):
+	start = time.perf_counter()
+	result = func()
+	return time.perf_counter() - start, result
+
+
+def main(projects=100, size=512):
+	rnd = random.Random(0)
+	tmp = tempfile.mkdtemp()
+	folders = os.path.join(tmp, "save_data")
+	path = os.path.join(tmp, "projects_index.json")
+	data, images = project(4, size, rnd)
+	for i in range(projects):
+		folder = os.path.join(folders, f"folder {i}")
+		os.makedirs(folder)
+		save_layers(folder, data, images)
+
+	t_all, _ = timed(lambda: read_all(folders))
+
+	def build():
+		index = load_index(path)
+		refresh(index, folders)
+		save_index(index, path)
+		return index
+	t_build, index = timed(build)
+	assert len(index["projects"]) == projects
+
+	def reopen():
+		index = load_index(path)
+		assert not refresh(index, folders)
+		return index
+	t_open, index = timed(reopen)
+	entry = index["projects"]["folder 0"]
+	assert (entry["layers"], entry["w"], entry["h"]) == (4, size, size)
+
+	# 1つだけ書き換え、1つ消す
+	save_layers(os.path.join(folders, "folder 1"), data, images)
+	os.utime(os.path.join(folders, "folder 1", "data.json"), (0, 0))
+	shutil.rmtree(os.path.join(folders, "folder 2"))
+	t_update, changed = timed(lambda: refresh(index, folders))
+	assert changed and "folder 2" not in index["projects"]
+	assert index["projects"]["folder 1"]["mtime"] == 0
+	assert os.path.exists(thumb_path(folders, "folder 1"))
+
+	print(f"{projects} projects, {size}x{size}, thumbnail {THUMB_SIZE}px")
+	print(f"  decode all   {t_all * 1000:8.1f} ms")
+	print(f"  build index  {t_build * 1000:8.1f} ms")
+	print(f"  open index   {t_open * 1000:8.1f} ms")
+	print(f"  1 changed    {t_update * 1000:8.1f} ms")
+	shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+	main(*(int(v) for v in sys.argv[1:3]))
@@ -0,0 +1,51 @@
+"""
+アルファ乗算の比較 (Pythonista なしで実行可)
+	python -m bench.premul
+"""
+from PIL import Image, ImageChops
+import os
+import sys
+import timeit
+
+from mym.premul import PremulBuffer, premultiply
+
+
+SIZES = (16, 64, 256, 512, 1024)
+
+
+def legacy(img):
+	# 以前の my_funcs.image4scene
+	r, g, b, a = img.split()
+	r = ImageChops.multiply(r, a)
+	g = ImageChops.multiply(g, a)
+	b = ImageChops.multiply(b, a)
+	return Image.merge("RGBA", (r, g, b, a))
+
+
+def main(sizes=SIZES):
+	cases = ("chops", "one-off", "reused", "64px box")
+	print("size".rjust(6), *(c.rjust(10) for c in cases), "  (ms / call)")
+	buffer = PremulBuffer()
+	for size in sizes:
+		img = Image.frombytes("RGBA", (size, size), os.urandom(size * size * 4))
+		box = (0, 0, min(size, 64), min(size, 64))
+		assert premultiply(img, None, buffer).tobytes() == legacy(img).tobytes()
+		assert premultiply(img).tobytes() == legacy(img).tobytes()
+		assert premultiply(img, box).tobytes() == legacy(img.crop(box)).tobytes()
+		assert premultiply(img, box, buffer).tobytes() == legacy(img.crop(box)).tobytes()
+		
+		funcs = (
+			lambda: legacy(img),
+			lambda: premultiply(img),
+			lambda: premultiply(img, None, buffer),
+			lambda: premultiply(img, box, buffer))
+		n = max(3, 2 ** 20 // (size * size))
+		row = []
+		for func in funcs:
+			t = timeit.timeit(func, number=n) / n
+			row.append(f"{t * 1000:10.3f}")
+		print(f"{size:>6}", *row)
+
+
+if __name__ == "__main__":
+	main(tuple(int(v) for v in sys.argv[1:]) or SIZES)
@@ -0,0 +1,43 @@
+"""
+テクスチャ用エンコードの比較 (Pythonista なしで実行可)
+	python -m bench.texenc
+"""
+from PIL import Image
+import io
+import os
+import sys
+import timeit
+
+from mym.texenc import ENCODERS
+
+
+SIZES = (16, 64, 256, 512, 1024)
+
+
+def sample(size):
+	img = Image.frombytes("RGBA", (size, size), os.urandom(size * size * 4))
+	return img
+
+
+def main(sizes=SIZES, number=None):
+	names = list(ENCODERS)
+	print("size".rjust(6), *(n.rjust(10) for n in names), "  (ms / encode)")
+	for size in sizes:
+		img = sample(size)
+		
+		# raw は PIL の BMP と同じバイト列になること
+		with io.BytesIO() as f:
+			img.save(f, format="bmp")
+			assert ENCODERS["raw"].encode(img) == f.getvalue()
+		
+		n = number or max(3, 2 ** 20 // (size * size))
+		row = []
+		for name in names:
+			enc = ENCODERS[name]
+			t = timeit.timeit(lambda: enc.encode(img), number=n) / n
+			row.append(f"{t * 1000:10.3f}")
+		print(f"{size:>6}", *row)
+
+
+if __name__ == "__main__":
+	main(tuple(int(v) for v in sys.argv[1:]) or SIZES)
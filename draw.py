@@ -1,24 +1,38 @@
-from PIL import Image, ImageChops, ImageColor, ImageDraw, GifImagePlugin
-import numpy as np
+from PIL import Image, ImageColor, ImageDraw, GifImagePlugin
 
 from scene import *
 import sound
 import ui
 
+from collections import OrderedDict, deque
 from typing import NamedTuple
 
 import clipboard
 import datetime
 import dialogs
+import itertools
 import json
+import math
 import os
+import threading
 
 from my_files import my_files
 from my_funcs import image4scene, sc_gif
 from my_nodes import ButtonNode, TTLNode
 from my_views import MoveView
 
-from mym.img2tex import img2tex, img2ui
+from mym.history import (
+	AddLayer, Clear, Document, Extent, History, ImageReplace, MoveLayer,
+	PixelDiff, RemoveLayer, is_shared, make_command, release, share)
+from mym.img2tex import get_default_encoder, img2tex, img2ui
+from mym.index import load_index, save_index, update_project
+from mym.indexed import save_png
+from mym.journal import Journal
+from mym.autosave import Autosaver
+from mym.project import (
+	STACKED, LazyImage, layer_file, load_layers, write_project)
+from mym.premul import PremulBuffer
+from mym.thumbnail import Thumbnailer
 pil2tex = img2tex
 pil2ui = img2ui
 
@@ -39,6 +53,7 @@ LIGHT_GRAY = (0.8, 0.8, 0.8, 1.0)
 GRAY = (0.6, 0.6, 0.6, 1.0)
 BLACK = (0.0, 0.0, 0.0, 1.0)
 CLEAR = (0, 0, 0, 0)
+MASK = 255  # Overlay のマスクに描く値
 
 MODE_DEFAULT = 0
 MODE_MOVE = 1
@@ -55,32 +70,465 @@ TOOL_CIRCLE = 6
 TOOL_LINE = 7
 TOOL_MOVE = 8
 
-
-class UndoData:
-	__slots__ = ['type', 'key', 'number', 'image']
-	
-	def __init__(self, type):
-		assert type in {"sub", "image", "add_layer", "remove_layer"}
-		self.type = type
-		self.key = None
-		self.number = None
-		self.image = None
+TILE_SIZE = 64
+THUMB_SIZE = 128  # 64pt の ImageView (Retina)
+VERSIONS = itertools.count(1)  # 画像の内容ごとに振る通し番号
+LOAD_LOCK = threading.Lock()  # Layer.load と set_image
+LARGE_IMAGE = 2048 * 2048
+UNDO_BUDGET = 64 * 1024 * 1024  # 履歴に使うバイト数の上限
+JOURNAL = 'history.journal'  # プロジェクトのフォルダに置く履歴
 
 
 class Layer:
-	__slots__ = ['image', 'node', 'number']
+	"""
+	画像は1枚のまま、表示は TILE_SIZE ごとのスプライトに分けて持つ
+	完全に透明なタイルはスプライトを作らない
+	テクスチャは pil2tex を呼ぶまで作らない
+	version: 画像を書き換えるたびに新しい番号になる
+	saved: ファイルに書いたときの version (違えば書き直す)
+	img に LazyImage を渡すと、image を最初に読んだとき (どのスレッドでも) に開く
+	"""
+	__slots__ = [
+		'_image', 'lazy', 'node', 'number', 'tiles', 'dirty', 'buffer',
+		'version', 'uploaded', 'saved']
 	
 	def __init__(self, img, number=0):
-		self.image = img
-		self.node = SpriteNode(anchor_point=(0, 1))
+		self.node = Node()
 		self.node.z_position = number
 		self.number = int(number)
-		self.pil2tex()
+		self.tiles = {}
+		self.dirty = set()
+		self.buffer = PremulBuffer()
+		self.version = 0
+		self.uploaded = 0
+		self.saved = None
+		self._image = None
+		self.lazy = None
+		if isinstance(img, LazyImage):
+			# 大きさはわかるので、開かずに全体を転送待ちにしておく
+			self.lazy = img
+			self.mark()
+		else:
+			self.image = img
+	
+	@property
+	def image(self):
+		img = self._image
+		if img is None:
+			img = self.load()
+		return img
+	
+	@image.setter
+	def image(self, img):
+		self.set_image(img)
+	
+	@property
+	def size(self):
+		"""画像を読まずにわかる大きさ"""
+		lazy = self.lazy
+		if lazy is not None:
+			return lazy.size
+		return self._image.size
+	
+	@property
+	def modified(self):
+		"""最後に保存してから書き換えられた"""
+		return self.saved != self.version
+	
+	def load(self):
+		"""まだ開いていない画像を開く 開くのはロックの外 (別スレッドからも呼ばれる)"""
+		lazy = self.lazy
+		if lazy is None:
+			return self._image
+		img = lazy.open()
+		with LOAD_LOCK:
+			if self.lazy is lazy:
+				self._image = img
+				self.lazy = None
+			return self._image
+	
+	def set_image(self, img, box=None):
+		"""box: 前の画像から変わった範囲 (None なら全体)"""
+		with LOAD_LOCK:
+			self._image = img
+			self.lazy = None
+		self.mark(box)
+	
+	def own(self):
+		"""
+		その場で書き換えてよい画像を返す
+		共有している画像 (mym.history.share) なら複製する 中身は同じなので転送はしない
+		"""
+		img = self.image
+		if is_shared(img):
+			release(img)
+			img = self._image = img.copy()
+		return img
+	
+	def mark(self, box=None):
+		"""box の範囲のタイルを次の pil2tex で転送する 画像内に収めた box を返す"""
+		self.version = next(VERSIONS)
+		if box is None:
+			self.dirty.update(self.tiles)
+			box = (0, 0, *self.size)
+		box = clip_box(box, self.size)
+		if box is None:
+			return None
+		x0, y0, x1, y1 = box
+		for ty in range(y0 // TILE_SIZE, (y1 - 1) // TILE_SIZE + 1):
+			for tx in range(x0 // TILE_SIZE, (x1 - 1) // TILE_SIZE + 1):
+				self.dirty.add((tx, ty))
+		return (x0, y0, x1, y1)
 	
 	def pil2tex(self):
-		texture_img = pil2tex(image4scene(self.image))
-		texture_img.filtering_mode = FILTERING_NEAREST
-		self.node.texture = texture_img
+		if self.uploaded == self.version:
+			return
+		w, h = self.image.size
+		for key in self.dirty:
+			tx, ty = key
+			x0 = tx * TILE_SIZE
+			y0 = ty * TILE_SIZE
+			x1 = min(w, x0 + TILE_SIZE)
+			y1 = min(h, y0 + TILE_SIZE)
+			
+			tile = None
+			if x0 < x1 and y0 < y1:
+				tile = self.tile_image((x0, y0, x1, y1))
+			
+			node = self.tiles.get(key)
+			if tile is None:
+				if node is not None:
+					node.remove_from_parent()
+					del self.tiles[key]
+				continue
+			
+			texture_img = pil2tex(tile)
+			texture_img.filtering_mode = FILTERING_NEAREST
+			if node is None:
+				node = SpriteNode(anchor_point=(0, 1), parent=self.node)
+				node.position = (x0, -y0)
+				self.tiles[key] = node
+			node.texture = texture_img
+			node.size = (x1 - x0, y1 - y0)
+		self.dirty.clear()
+		self.uploaded = self.version
+	
+	def tile_image(self, box):
+		"""
+		box の範囲の画像 (透明なら None)
+		アルファ乗算済みを受け取るエンコーダーのときだけ乗算する
+		"""
+		if get_default_encoder().premultiplied:
+			tile = image4scene(self.image, box, self.buffer)
+		else:
+			tile = self.image.crop(box)
+		if tile.getextrema()[3][1] == 0:
+			return None
+		return tile
+
+
+class Overlay(Layer):
+	"""
+	描画中のプレビュー用レイヤー
+	単色のツールは "L" のマスクに描き、色は表示と確定のときに付ける
+	範囲選択 (TOOL_CAP) だけは "RGBA" で描く
+	drawn: リセットしてから書き込んだ範囲
+	draw: image に描くための ImageDraw
+	"""
+	__slots__ = ['drawn', 'draw', 'color', 'premul']
+	
+	def __init__(self, size, mode="L"):
+		self.drawn = None
+		self.color = CLEAR
+		self.premul = CLEAR
+		Layer.__init__(self, Image.new(mode, size, 0))
+		self.drawn = None
+	
+	@property
+	def mode(self):
+		return self._image.mode
+	
+	def set_image(self, img, box=None):
+		Layer.set_image(self, img, box)
+		self.draw = ImageDraw.Draw(img)
+	
+	def set_color(self, color):
+		"""マスクに付ける色 (RGBA)"""
+		if color == self.color:
+			return
+		self.color = color
+		a = color[3]
+		self.premul = (*(v * a // 255 for v in color[0:3]), a)
+		if self.mode == "L" and self.drawn is not None:
+			Layer.mark(self, self.drawn)
+	
+	def set_mode(self, mode):
+		if mode != self.mode:
+			self.image = Image.new(mode, self._image.size, 0)
+			self.drawn = None
+	
+	def mark(self, box=None):
+		box = Layer.mark(self, box)
+		self.drawn = union_box(self.drawn, box)
+		return box
+	
+	def tile_image(self, box):
+		if self.mode != "L":
+			return Layer.tile_image(self, box)
+		mask = self._image.crop(box)
+		if mask.getbbox() is None:
+			return None
+		tile = self.buffer.get(mask.size)[0]
+		tile.paste(CLEAR)
+		color = self.premul if get_default_encoder().premultiplied else self.color
+		tile.paste(color, None, mask)
+		return tile
+	
+	def apply(self, img, erase=False, origin=(0, 0)):
+		"""
+		描いた範囲だけを img に重ねる (erase なら消す)
+		img は書き換えられる
+		origin: img の左上がオーバーレイのどこにあたるか
+		"""
+		box = self.drawn
+		if box is None:
+			return
+		dest = offset_box(box, -origin[0], -origin[1])
+		if self.mode != "L":
+			if erase:
+				img.paste(CLEAR, dest, self._image.crop(box))
+			else:
+				img.alpha_composite(self._image, dest[0:2], box)
+			return
+		mask = self._image.crop(box)
+		if erase:
+			img.paste(CLEAR, dest, mask)
+		elif self.color[3] == 255:
+			img.paste(self.color, dest, mask)
+		else:
+			src = Image.new("RGBA", mask.size, CLEAR)
+			src.paste(self.color, None, mask)
+			img.alpha_composite(src, dest[0:2])
+	
+	def clear(self):
+		# drawn の外側は既に透明
+		if self.drawn is not None:
+			self.image.paste(0, self.drawn)
+			Layer.mark(self, self.drawn)
+	
+	def reset(self):
+		self.clear()
+		self.drawn = None
+		self.pil2tex()
+	
+	def resize(self, size):
+		self.image = Image.new(self.mode, size, 0)
+		self.drawn = None
+		self.pil2tex()
+
+
+class SceneDocument(Document):
+	"""
+	履歴のコマンドが MyScene のレイヤーを書き換えたときに表示を合わせる
+	begin から end の間は画面の更新を溜めて、flush で1回にまとめる
+	"""
+	
+	def __init__(self, scene):
+		self.scene = scene
+		self.pending = set()  # 画像が変わったレイヤー
+		self.reorder = False  # レイヤーの数や順番が変わった
+		Document.__init__(self, scene.layers)
+	
+	def new_layer(self, image, number):
+		return Layer(image, number)
+	
+	def set_number(self, lay, number):
+		lay.number = number
+		lay.node.z_position = number
+	
+	def changed(self, key, box):
+		sc = self.scene
+		lay = self.layers[key]
+		if box is not None:
+			lay.mark(box)
+		if self.depth:
+			self.pending.add(key)
+		elif sc.layer_editing:
+			sc.layer_edit_img(key)
+		elif key != sc.cur_key:
+			sc.compositor.invalidate(lay)
+			sc.selector_img(key)
+		elif box is None:
+			sc.new_image(lay)
+		else:
+			lay.pil2tex()
+			sc.selector_img(key)
+	
+	def added(self, key):
+		sc = self.scene
+		sc.selector_add(key)
+		if sc.layer_editing:
+			sc.layer_edit_add_view(key, self.layers[key])
+		if self.depth:
+			self.reorder = True
+			return
+		sc.compositor.invalidate()
+		if sc.layer_editing:
+			sc.layer_edit_layout()
+	
+	def removed(self, key, lay):
+		sc = self.scene
+		lay.node.remove_from_parent()
+		self.pending.discard(key)
+		if sc.layer_editing:
+			sc.layer_edit_remove_view(key)
+		if key == sc.cur_key:
+			# 下のレイヤー (一番下なら上のレイヤー) を選ぶ
+			sc.cur_key = self.order[max(0, lay.number - 1)]
+			if sc.layer_editing:
+				sc.layer_edit_current(sc.cur_key)
+			elif self.depth:
+				self.pending.add(sc.cur_key)
+			else:
+				sc.new_image(self.layers[sc.cur_key])
+		sc.selector_remove(key)
+		if self.depth:
+			self.reorder = True
+			return
+		sc.compositor.invalidate()
+		if sc.layer_editing:
+			sc.layer_edit_layout()
+	
+	def moved(self, key):
+		if self.depth:
+			self.reorder = True
+			return
+		sc = self.scene
+		sc.ov.node.z_position = sc.current_layer().number + 0.5
+		sc.selector_update()
+		sc.compositor.invalidate()
+		if sc.layer_editing:
+			sc.layer_edit_layout()
+	
+	def flush(self):
+		sc = self.scene
+		pending = self.pending
+		self.pending = set()
+		reorder = self.reorder
+		self.reorder = False
+		
+		if reorder:
+			sc.ov.node.z_position = sc.current_layer().number + 0.5
+			sc.selector_update()
+			sc.compositor.invalidate()
+		for key in pending:
+			if sc.layer_editing:
+				sc.layer_edit_img(key)
+			elif key != sc.cur_key:
+				sc.compositor.invalidate(self.layers[key])
+				sc.selector_img(key)
+		if sc.layer_editing:
+			if reorder:
+				sc.layer_edit_layout()
+		elif sc.cur_key in pending:
+			# 選択中のレイヤーのテクスチャはここで1回だけ作る
+			sc.new_image(sc.current_layer())
+
+
+class Compositor:
+	"""
+	選択中より下のレイヤーと上のレイヤーをそれぞれ1枚に合成して表示する
+	シーンに置くのは below, 選択中のレイヤー, ov, above だけになる
+	"""
+	__slots__ = [
+		'parent', 'active', 'below', 'above',
+		'dirty_below', 'dirty_above', 'suspended', 'signatures']
+	
+	def __init__(self, parent):
+		self.parent = parent
+		self.active = None
+		self.below = Layer(Image.new("RGBA", (1, 1), CLEAR))
+		self.above = Layer(Image.new("RGBA", (1, 1), CLEAR))
+		parent.add_child(self.below.node)
+		parent.add_child(self.above.node)
+		self.dirty_below = True
+		self.dirty_above = True
+		self.suspended = False
+		# 合成に使ったレイヤーの (version, alpha, number, 開いたか)
+		self.signatures = [None, None]
+	
+	def set_active(self, lay):
+		if lay is self.active:
+			return
+		if self.active is not None:
+			self.active.node.remove_from_parent()
+		self.active = lay
+		self.parent.add_child(lay.node)
+		self.invalidate()
+	
+	def invalidate(self, lay=None):
+		"""lay: 画像かアルファが変わったレイヤー (None なら並び替えなど)"""
+		if lay is None or self.active is None:
+			self.dirty_below = True
+			self.dirty_above = True
+		elif lay.number < self.active.number:
+			self.dirty_below = True
+		elif lay.number > self.active.number:
+			self.dirty_above = True
+	
+	def suspend(self):
+		self.suspended = True
+		self.below.node.alpha = 0
+		self.above.node.alpha = 0
+	
+	def resume(self):
+		self.suspended = False
+		self.below.node.alpha = 1
+		self.above.node.alpha = 1
+	
+	def update(self, layers):
+		if self.suspended or self.active is None:
+			return
+		number = self.active.number
+		# 先に戻す (合成中に別スレッドがレイヤーを開いたら次のフレームで作り直す)
+		if self.dirty_below:
+			self.dirty_below = False
+			self.rebuild(0, [lay for lay in layers if lay.number < number])
+		if self.dirty_above:
+			self.dirty_above = False
+			self.rebuild(1, [lay for lay in layers if lay.number > number])
+		# ov は number + 0.5
+		self.below.node.z_position = number - 0.5
+		self.above.node.z_position = number + 0.75
+	
+	def rebuild(self, index, lays):
+		lays.sort(key=lambda lay: lay.number)
+		signature = tuple(
+			(lay.version, lay.node.alpha, lay.number, lay.lazy is None) for lay in lays)
+		if signature == self.signatures[index]:
+			return
+		self.signatures[index] = signature
+		composite = (self.below, self.above)[index]
+		composite.image = self.flatten(lays)
+		composite.pil2tex()
+	
+	@staticmethod
+	def flatten(lays):
+		"""まだ開いていないレイヤーは飛ばす (開き終わったら invalidate される)"""
+		lays = sorted(lays, key=lambda lay: lay.number)
+		w = max([lay.size[0] for lay in lays], default=1)
+		h = max([lay.size[1] for lay in lays], default=1)
+		dst = Image.new("RGBA", (w, h), CLEAR)
+		for lay in lays:
+			a = lay.node.alpha
+			if a <= 0 or lay.lazy is not None:
+				continue
+			src = lay.image
+			if a < 1:
+				src = src.copy()
+				src.putalpha(src.getchannel("A").point(lambda v: int(v * a + 0.5)))
+			dst.alpha_composite(src)
+		return dst
 
 
 class Gui(ButtonNode):
@@ -177,6 +625,43 @@ class Pixel(NamedTuple):
 			pass
 		return Pixel(self[0] // other, self[1] // other)
 
+
+def pixel_box(*points):
+	"""点をすべて含む矩形 (x0, y0, x1, y1) x1, y1 は含まない"""
+	xs = [p[0] for p in points]
+	ys = [p[1] for p in points]
+	return (min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+
+
+def union_box(box1, box2):
+	if box1 is None:
+		return box2
+	if box2 is None:
+		return box1
+	return (
+		min(box1[0], box2[0]), min(box1[1], box2[1]),
+		max(box1[2], box2[2]), max(box1[3], box2[3]))
+
+
+def clip_box(box, size):
+	"""box を (0, 0, *size) の中に収める (空になれば None)"""
+	if box is None:
+		return None
+	w, h = size
+	x0, y0, x1, y1 = box
+	x0 = max(0, x0)
+	y0 = max(0, y0)
+	x1 = min(w, x1)
+	y1 = min(h, y1)
+	if x0 >= x1 or y0 >= y1:
+		return None
+	return (x0, y0, x1, y1)
+
+
+def offset_box(box, x, y):
+	return (box[0] + x, box[1] + y, box[2] + x, box[3] + y)
+
+
 # ---:
 
 
@@ -199,12 +684,20 @@ class MyScene (Scene):
 		self.switching = False
 		
 		self.layers = {}
+		self.selector_versions = {}
+		self.thumbnails = Thumbnailer()
 		self.cur_key = 0
 		self.next_key = 0
 		
-		self.undo_list = []
-		self.undo_index = -1
-		self.undo_limit = 100
+		self.history = History(UNDO_BUDGET)
+		
+		self.autosaver = Autosaver()
+		self.autosave = 60  # 秒 (0 なら自動保存しない)
+		self.autosave_idle = True  # 描いていないときだけ保存する
+		self.saved_time = 0.0
+		self.saved_meta = None
+		self.save_count = 0
+		self.layer_files = {}  # key -> 保存したファイル名
 		
 		self.move_start = Point(0, 0)
 		self.move = Vector2(0, 0)
@@ -214,6 +707,8 @@ class MyScene (Scene):
 		self.draw_start_point = Pixel(0, 0)
 		self.draw_point = Pixel(0, 0)
 		self.draw_prev_point = Pixel(-5, -5)
+		self.draw_points = []  # 前のフレームから増えた点
+		self.stroke = deque()  # (timestamp, Pixel) まだ描いていない入力
 		self.draw_method = self.draw_pencil
 		
 		self.cap_img_p = None
@@ -256,13 +751,7 @@ class MyScene (Scene):
 			os.mkdir(folder_path)
 		
 		tx = ''
-		# 画像の読み込み
-		try:
-			img = Image.open(f'{folder_path}/layers.png')
-		except FileNotFoundError:
-			tx += '画像ファイルが見つかりません。\n'
-			img = Image.open(f'{sample_path}/layers.png')
-		
+		image_path = folder_path
 		# データの読み込み
 		try:
 			with open(f'{folder_path}/data.json', 'r') as f:
@@ -271,35 +760,52 @@ class MyScene (Scene):
 			tx += 'JSONファイルが見つかりません。\n'
 			with open(f'{sample_path}/data.json', 'r') as f:
 				data = json.load(f)
-			data["layers"]["0"]["w"] = img.size[0]
-			data["layers"]["0"]["h"] = img.size[1]
+			# 古い形式の画像だけが残っていれば、それを1枚のレイヤーにする
+			try:
+				with Image.open(f'{folder_path}/{STACKED}') as img:
+					data["layers"]["0"]["w"] = img.size[0]
+					data["layers"]["0"]["h"] = img.size[1]
+			except FileNotFoundError:
+				image_path = sample_path
+		
+		# 画像の読み込み (レイヤーごとのファイルか、古い形式の layers.png)
+		# ここではファイルがあるかだけを見て、開くのは使うとき
+		images, missing = load_layers(image_path, data, lazy=True)
+		if missing:
+			tx += '画像ファイルが見つかりません。\n'
 		
 		if tx:
 			tx += '>サンプルデータをロードしました。'
 			self.new_message(tx)
 		
 		# レイヤーの設定
+		# キーは保存をまたいで変わらない (古いデータはキー = 順番)
 		self.cur_key = data["selected"]
-		self.next_key = len(data["layers"])
 		for k, v in data["layers"].items():
-			y = v["y"]
-			w = v["w"]
-			h = v["h"]
-			img2 = img.transform((w, h), Image.EXTENT, (0, y, w, y + h))
-			number = int(k)
-			try:
-				lay = Layer(img2, number)
-			except ValueError:
-				w = min(w, 256)
-				h = min(h, 256)
-				img2 = img.transform((w, h), Image.EXTENT, (0, y, w, y + h))
-				number = int(k)
-				lay = Layer(img2, number)
-				self.new_message(
-					'エラーが発生した為、\n'
-					'画像サイズを256pxに変更しました。')
+			key = int(k)
+			lay = Layer(images[key], v.get("n", key))
 			lay.node.alpha = v["a"]
-			self.layers[number] = lay
+			# 1枚ずつのファイルから読んだものは、書き換えるまで保存しない
+			if not tx and "file" in v:
+				lay.saved = lay.version
+				self.layer_files[key] = v["file"]
+			self.layers[key] = lay
+		self.save_count = data.get("save", 0)
+		self.next_key = data.get("next_key", max(self.layers) + 1)
+		# 壊れた data.json でも開けるように、使えないキーは直す
+		if self.cur_key not in self.layers:
+			self.cur_key = min(self.layers, key=lambda k: self.layers[k].number)
+		if self.next_key <= max(self.layers):
+			self.next_key = max(self.layers) + 1
+		self.doc = SceneDocument(self)
+		self.layer_editing = False
+		
+		# 履歴の読み込み (画像を保存した時点まで)
+		self.journal = Journal(f'{folder_path}/{JOURNAL}')
+		mark = None if tx else data.get("journal")
+		entries, index = self.journal.load(mark, make_command)
+		self.history.restore(entries, index)
+		self.history.journal = self.journal
 		
 		# パレットの設定
 		plt = {int(k): tuple(v) for k, v in data["palette"].items()}
@@ -313,6 +819,8 @@ class MyScene (Scene):
 		self.display_alert = data["display_alert"]
 		self.auto_tool = data["auto_tool"]
 		self.play_sound = data["play_sound"]
+		self.autosave = data.get("autosave", self.autosave)
+		self.autosave_idle = data.get("autosave_idle", self.autosave_idle)
 		
 		# 拡大の設定
 		self.zoom = data["zoom"]
@@ -327,65 +835,71 @@ class MyScene (Scene):
 		self.thick_grid = ShapeNode(grid_path, anchor_point=(0, 1))
 		self.grid.add_child(self.thick_grid)
 		self.add_child(self.grid)
+		self.grid_cache = OrderedDict()
+		self.grid_key = None
+		self.grid_origin = (0, 0)
 		
 		# レイヤー関係諸々
 		self.img_bg = SpriteNode(parent=self, anchor_point=(0, 1))
 		self.img_bg.z_position = -1
 		self.img_bg.color = self.bg_color
 		
-		self.ov = Layer(Image.new("RGBA", (16, 16), CLEAR))
+		self.ov = Overlay((16, 16))
 		self.ov.node.z_position = self.cur_key + 0.5
 		self.img_bg.add_child(self.ov.node)
 		
-		self.draw_ov = ImageDraw.Draw(self.ov.image)
+		self.compositor = Compositor(self.img_bg)
 		
-		for key, lay in self.layers.items():
+		for key in self.layers:
 			self.selector_add(key)
-			if key == self.cur_key:
-				self.new_image(lay)
-			else:
-				lay.pil2tex()
-			self.img_bg.add_child(lay.node)
+		self.new_image(self.current_layer())
 		
 		# セットアップおわり
-		self.gui_undo.normal_color = LIGHT_GRAY
-		self.gui_redo.normal_color = LIGHT_GRAY
+		self.undo_color()
 		self.gui_pencil.normal_color = GRAY
 		self.grid_color()
 		
-		assert self.cur_key < len(self.layers) == self.next_key
+		if not tx:
+			self.saved_meta = self.project_meta()
+		self.saved_time = self.t
 		
+		# 選択中のレイヤーは new_image で開いた 残りは近い順に裏で開く
+		number = self.current_layer().number
+		lays = sorted(self.layers.values(), key=lambda lay: abs(lay.number - number))
+		self.loading = True
+		threading.Thread(target=self.load_layers, args=(lays,), daemon=True).start()
 		self.wait = False
 	
 	def did_change_size(self):
 		pass
 	
 	def update(self):
-		if self.mode is MODE_DRAW and self.draw_point != self.draw_prev_point:
-			self.draw_method()
-			self.draw_prev_point = self.draw_point
-	
-	def stop(self):
-		folder_path = f'files/save_data/{self.folder_name}'
-		w = 1
-		h = 0
-		for lay in self.layers.values():
-			w = max(w, lay.image.size[0])
-			h += lay.image.size[1]
-		img = Image.new("RGBA", (w, max(1, h)), CLEAR)
-		
-		y = 0
+		if self.mode is MODE_DRAW:
+			self.flush_stroke()
+		self.compositor.update(self.layers.values())
+		self.autosave_update()
+	
+	def load_layers(self, lays):
+		"""まだ開いていないレイヤーを開く (別スレッド)"""
+		for lay in lays:
+			# シーンを閉じたら残りは開かない
+			if not self.loading:
+				return
+			try:
+				lay.load()
+			except OSError:
+				# 開けないレイヤーは残し、シーンのスレッドで読んだときに知らせる
+				continue
+			self.compositor.invalidate(lay)
+	
+	def project_meta(self):
+		"""data.json に書く内容 (レイヤーの画像のファイル名と履歴の印を除く)"""
 		dict_layers = {}
 		for key, lay in self.layers.items():
-			img.paste(lay.image, (0, y))
-			w, h = lay.image.size
+			w, h = lay.size
 			a = lay.node.alpha
-			dict_lay = {"y": y, "w": w, "h": h, "a": a}
-			y += h
-			dict_layers[lay.number] = dict_lay
-		img.save(f'{folder_path}/layers.png', 'png')
-		
-		dict_data = {
+			dict_layers[key] = {"w": w, "h": h, "a": a, "n": lay.number}
+		return {
 			"bg_color": self.bg_color,
 			"color_type": self.color_type,
 			"grid_size": self.grid_size,
@@ -393,13 +907,86 @@ class MyScene (Scene):
 			"display_alert": self.display_alert,
 			"auto_tool": self.auto_tool,
 			"play_sound": self.play_sound,
+			"autosave": self.autosave,
+			"autosave_idle": self.autosave_idle,
 			"zoom": self.zoom,
-			"selected": self.current_layer().number,
+			"selected": self.cur_key,
+			"next_key": self.next_key,
 			"layers": dict_layers,
-			"palette": self.colors
+			"palette": dict(self.colors)
 			}
-		with open(f'{folder_path}/data.json', 'w') as f:
-			json.dump(dict_data, f, indent=2)
+	
+	def snapshot(self):
+		"""
+		保存する内容を控える (シーンのスレッドで呼ぶ)
+		書き換えたレイヤーの画像だけを、コピーせずに share して渡す
+		"""
+		self.save_count += 1
+		data = self.project_meta()
+		self.saved_meta = self.project_meta()
+		images = {}
+		for key, lay in self.layers.items():
+			if lay.modified or key not in self.layer_files:
+				name = layer_file(key, self.save_count)
+				images[name] = share(lay.image)
+				self.layer_files[key] = name
+				lay.saved = lay.version
+			data["layers"][key]["file"] = self.layer_files[key]
+		data["save"] = self.save_count
+		data["journal"] = self.journal.next_mark()
+		return images, data
+	
+	def autosave_check(self):
+		"""別スレッドの保存が失敗していたら、次の保存で全部書き直す"""
+		if self.autosaver.error is None:
+			return
+		self.autosaver.error = None
+		for lay in self.layers.values():
+			lay.saved = None
+		self.saved_meta = None
+		self.new_message('自動保存に失敗しました。')
+	
+	def autosave_update(self):
+		self.autosave_check()
+		if self.autosave <= 0 or self.wait or self.autosaver.busy:
+			return
+		if self.t - self.saved_time < self.autosave:
+			return
+		if self.autosave_idle and (self.mode is not MODE_DEFAULT or self.touches):
+			return
+		self.saved_time = self.t
+		
+		modified = any(lay.modified for lay in self.layers.values())
+		if not modified and self.project_meta() == self.saved_meta:
+			return
+		images, data = self.snapshot()
+		# 印は先に書いておく (data.json が書けなければ前の印が使われる)
+		self.journal.saved()
+		self.autosaver.save(f'files/save_data/{self.folder_name}', images, data)
+	
+	def stop(self):
+		folder_path = f'files/save_data/{self.folder_name}'
+		# 裏のスレッドを終える (保存は頼んだ分を済ませてから)
+		self.loading = False
+		self.thumbnails.stop()
+		self.autosaver.stop()
+		self.autosaver.wait()
+		self.autosave_check()
+		
+		# 書き換えたレイヤーだけを書き直す
+		images, data = self.snapshot()
+		write_project(folder_path, images, data)
+		for img in images.values():
+			release(img)
+		# data.json の後に印を書く (途中で止まれば履歴は使われない)
+		self.journal.saved(self.history.entries, self.history.index)
+		self.journal.close()
+		
+		# プロジェクト一覧の索引とサムネイル (手元の画像から作るので読み直さない)
+		bottom = min(self.layers.values(), key=lambda lay: lay.number)
+		index = load_index()
+		update_project(index, 'files/save_data', self.folder_name, data, bottom.image)
+		save_index(index)
 	
 	# ---:
 	
@@ -453,22 +1040,28 @@ class MyScene (Scene):
 	
 	# ---:
 	
-	def draw_pencil(self):
+	def draw_polyline(self):
+		"""前のフレームからの点をまとめて1本の折れ線で描く"""
+		points = self.draw_points
 		if self.draw_prev_point != (-5, -5):
-			self.draw_ov.line([self.draw_prev_point, self.draw_point], self.col_ov)
+			points = [self.draw_prev_point, *points]
+		if len(points) > 1:
+			self.ov.draw.line(points, MASK)
 		else:
-			self.draw_ov.point(self.draw_point, self.col_ov)
+			self.ov.draw.point(points, MASK)
+		self.ov.mark(pixel_box(*points))
+	
+	def draw_pencil(self):
+		self.draw_polyline()
 		self.ov.pil2tex()
 	
 	def draw_eraser(self):
 		if self.erase_rect:
-			self.ov.image.paste(CLEAR)
-			self.draw_ov.rectangle([self.draw_start_point, self.draw_point], fill=self.bg_color)
+			self.ov.clear()
+			self.ov.draw.rectangle([self.draw_start_point, self.draw_point], fill=MASK)
+			self.ov.mark(pixel_box(self.draw_start_point, self.draw_point))
 		else:
-			if self.draw_prev_point != (-5, -5):
-				self.draw_ov.line([self.draw_prev_point, self.draw_point], self.bg_color)
-			else:
-				self.draw_ov.point(self.draw_point, self.bg_color)
+			self.draw_polyline()
 		self.ov.pil2tex()
 	
 	def pick_color(self):
@@ -495,23 +1088,27 @@ class MyScene (Scene):
 		self.choose_color(self.color_key)
 	
 	def copy_and_paste(self):
-		self.ov.image.paste(CLEAR)
+		self.ov.clear()
 		
 		if self.cap_stage == 0:
-			self.draw_ov.rectangle([self.draw_start_point, self.draw_point], outline=self.col_c)
+			self.ov.draw.rectangle([self.draw_start_point, self.draw_point], outline=self.col_c)
+			self.ov.mark(pixel_box(self.draw_start_point, self.draw_point))
 			
 		elif self.cap_stage == 2:
-			box = tuple(self.draw_point - Pixel._make(self.cap_img_p.size) // 2)
-			self.ov.image.paste(self.cap_img_s, box)
+			box = self.draw_point - Pixel._make(self.cap_img_p.size) // 2
+			self.ov.image.paste(self.cap_img_s, tuple(box))
+			self.ov.mark((*box, *(box + self.cap_img_s.size)))
 		
 		# 1&3
 		else:
 			if self.cap_cut and self.cap_stage == 1:
 				box = (*self.cap_point, *(self.cap_point + self.cap_img_p.size))
 				self.ov.image.paste(self.bg_color, box)
+				self.ov.mark(box)
 			move = self.draw_start_point - self.draw_point
-			min_point = tuple(self.cap_point - move)
-			self.ov.image.paste(self.cap_img_s, min_point)
+			min_point = self.cap_point - move
+			self.ov.image.paste(self.cap_img_s, tuple(min_point))
+			self.ov.mark((*min_point, *(min_point + self.cap_img_s.size)))
 			
 		self.ov.pil2tex()
 	
@@ -522,23 +1119,28 @@ class MyScene (Scene):
 		if not (x_in and y_in):
 			return
 			
+		color = cul.image.getpixel(self.draw_point)
+		if color == self.col_ov:
+			return
 		img = cul.image.copy()
-		color = img.getpixel(self.draw_point)
-		if color != self.col_ov:
-			ImageDraw.floodfill(img, self.draw_point, self.col_ov)
+		ImageDraw.floodfill(img, self.draw_point, self.col_ov)
 		
-		if self.undo_save("sub", cul.image, img, self.cur_key):
-			cul.image = img
+		cmd = PixelDiff.from_images(self.cur_key, cul.image, img)
+		if cmd is not None:
+			self.push_command(cmd)
+			# 塗った範囲のタイルだけを転送する
+			cul.set_image(img, cmd.box)
 			cul.pil2tex()
 			self.selector_img(self.cur_key)
 	
 	def draw_rect(self):
-		self.ov.image.paste(CLEAR)
+		self.ov.clear()
 		
 		if self.rect_fill:
-			self.draw_ov.rectangle([self.draw_start_point, self.draw_point], fill=self.col_ov)
+			self.ov.draw.rectangle([self.draw_start_point, self.draw_point], fill=MASK)
 		else:
-			self.draw_ov.rectangle([self.draw_start_point, self.draw_point], outline=self.col_ov)
+			self.ov.draw.rectangle([self.draw_start_point, self.draw_point], outline=MASK)
+		self.ov.mark(pixel_box(self.draw_start_point, self.draw_point))
 		self.ov.pil2tex()
 	
 	def draw_circle(self):
@@ -546,18 +1148,20 @@ class MyScene (Scene):
 		x1, y1 = self.draw_point
 		min_xy = (min(x0, x1), min(y0, y1))
 		max_xy = (max(x0, x1), max(y0, y1))
-		self.ov.image.paste(CLEAR)
+		self.ov.clear()
 		
 		if self.circle_fill:
-			self.draw_ov.ellipse([min_xy, max_xy], fill=self.col_ov)
+			self.ov.draw.ellipse([min_xy, max_xy], fill=MASK)
 		else:
-			self.draw_ov.ellipse([min_xy, max_xy], outline=self.col_ov)
+			self.ov.draw.ellipse([min_xy, max_xy], outline=MASK)
+		self.ov.mark(pixel_box(min_xy, max_xy))
 		self.ov.pil2tex()
 	
 	def draw_line(self):
-		self.ov.image.paste(CLEAR)
+		self.ov.clear()
 		
-		self.draw_ov.line([self.draw_start_point, self.draw_point], self.col_ov)
+		self.ov.draw.line([self.draw_start_point, self.draw_point], MASK)
+		self.ov.mark(pixel_box(self.draw_start_point, self.draw_point))
 		self.ov.pil2tex()
 	
 	# ---:
@@ -568,6 +1172,32 @@ class MyScene (Scene):
 		y = int((bg_y - touch.location.y) // self.zoom)
 		return Pixel(x, y)
 	
+	def set_overlay(self):
+		if self.tool is TOOL_CAP:
+			self.ov.set_mode("RGBA")
+		else:
+			self.ov.set_mode("L")
+			if self.tool is TOOL_ERASER:
+				self.ov.set_color(ImageColor.getcolor(self.bg_color, "RGBA"))
+			else:
+				self.ov.set_color(self.col_ov)
+	
+	def push_stroke(self, touch):
+		"""タッチの入力をすべて溜めておく 描くのは update でまとめて"""
+		p = self.get_draw_point(touch)
+		last = self.stroke[-1][1] if self.stroke else self.draw_point
+		if p != last:
+			self.stroke.append((touch.timestamp, p))
+	
+	def flush_stroke(self):
+		if not self.stroke:
+			return
+		self.draw_points = [p for _, p in self.stroke]
+		self.stroke.clear()
+		self.draw_point = self.draw_points[-1]
+		self.draw_method()
+		self.draw_prev_point = self.draw_point
+	
 	# ---:
 	
 	def touch_began(self, touch):
@@ -595,6 +1225,9 @@ class MyScene (Scene):
 				p = self.get_draw_point(touch)
 				self.draw_start_point = p
 				self.draw_point = p
+				self.set_overlay()
+				self.stroke.clear()
+				self.stroke.append((touch.timestamp, p))
 		
 		elif t_length == 2 and (self.tool is not TOOL_MOVE):
 			Gui.detect_ended(touch)
@@ -615,12 +1248,10 @@ class MyScene (Scene):
 			elif self.mode is MODE_MOVE:
 				self.move = touch.location - self.move_start
 				self.set_pos()
-				x = touch.location.x - self.touch_x
-				y = touch.location.y - self.touch_y + self.size.h
-				self.grid.position = (x, y)
+				self.set_grid()
 			
 			elif self.mode is MODE_DRAW:
-				self.draw_point = self.get_draw_point(touch)
+				self.push_stroke(touch)
 	
 	def touch_ended(self, touch):
 		if self.wait:
@@ -638,6 +1269,8 @@ class MyScene (Scene):
 			Gui.detect_ended(touch)
 		
 		elif self.mode is MODE_DRAW:
+			# 最後のフレームの後に来た入力も描いてから確定する
+			self.flush_stroke()
 			cul = self.current_layer()
 			
 			if self.tool is TOOL_PICKER:
@@ -677,38 +1310,42 @@ class MyScene (Scene):
 					self.cap_stage = 3
 				
 			else:
-				rgba = cul.image.copy()
+				cut_box = None
 				
 				if self.tool is TOOL_CAP:
 					move = self.draw_start_point - self.draw_point
-					box = tuple(self.cap_point - move)
-					self.ov.image.paste(CLEAR)
-					self.ov.image.paste(self.cap_img_p, box)
+					box = self.cap_point - move
+					self.ov.clear()
+					self.ov.image.paste(self.cap_img_p, tuple(box))
+					self.ov.mark((*box, *(box + self.cap_img_p.size)))
 					
 					if self.cap_stage == 1:
 						if self.cap_cut:
-							box = (*self.cap_point, *(self.cap_point + self.cap_img_p.size))
-							rgba.paste(CLEAR, box)
+							cut_box = (*self.cap_point, *(self.cap_point + self.cap_img_p.size))
 						self.cap_stage = 0
 						self.copy_or_cut()
 					else:
 						self.cap_stage = 2
 				
-				if self.tool is TOOL_ERASER:
-					rgba.paste(CLEAR, (0, 0), self.ov.image)
-				else:
-					rgba = Image.alpha_composite(rgba, self.ov.image)
-				
-				if self.undo_save("sub", cul.image, rgba, self.cur_key):
-					cul.image = rgba
-					cul.pil2tex()
-					self.selector_img(self.cur_key)
+				# 触った範囲だけを切り出して確定する
+				box = clip_box(union_box(self.ov.drawn, cut_box), cul.image.size)
+				if box is not None:
+					rgba = cul.image.crop(box)
+					if cut_box is not None:
+						rgba.paste(CLEAR, offset_box(cut_box, -box[0], -box[1]))
+					self.ov.apply(rgba, self.tool is TOOL_ERASER, box[0:2])
+					
+					if self.undo_save("sub", cul.image, rgba, self.cur_key, box):
+						cul.own().paste(rgba, box)
+						cul.mark(box)
+						cul.pil2tex()
+						self.selector_img(self.cur_key)
 		
 		self.draw_prev_point = Pixel(-5, -5)
+		self.stroke.clear()
 		
 		if self.tool is not TOOL_MOVE and self.cap_stage in {0, 2}:
-			self.ov.image.paste(CLEAR)
-			self.ov.pil2tex()
+			self.ov.reset()
 		
 		self.set_grid()
 		self.mode = MODE_DEFAULT
@@ -730,119 +1367,65 @@ class MyScene (Scene):
 	# ---:
 	
 	def bt_undo(self, bt):
-		if self.undo_index + 1:
+		if self.history.can_undo():
 			self.sound_effect('ui:switch8')
 			self.undo_load(False)
 			self.gui_redo.normal_color = WHITE
-			if self.undo_index == -1:
+			if not self.history.can_undo():
 				self.gui_undo.normal_color = LIGHT_GRAY
 	
 	def bt_redo(self, bt):
-		length = len(self.undo_list)
-		if self.undo_index + 1 < length:
+		if self.history.can_redo():
 			self.sound_effect('ui:switch9')
 			self.undo_load(True)
 			self.gui_undo.normal_color = WHITE
-			if self.undo_index + 1 == length:
+			if not self.history.can_redo():
 				self.gui_redo.normal_color = LIGHT_GRAY
 	
-	def undo_save(self, type, img1, img2, key):
-		if np.array_equal(np.array(img1), np.array(img2)):
-			return False
-		
-		undo = UndoData(type)
-		undo.key = key
-		if type == "sub":
-			img3 = ImageChops.subtract_modulo(img1, img2)
-			undo.image = img3
+	def undo_color(self):
+		if self.history.can_undo():
+			self.gui_undo.normal_color = WHITE
 		else:
-			undo.image = (img1, img2)
-		self.undo_list[self.undo_index + 1:] = [undo]
-		
-		length = len(self.undo_list)
-		if length > self.undo_limit:
-			count = length - self.undo_limit
-			del self.undo_list[:count]
-		self.undo_index = min(self.undo_limit - 1, self.undo_index + 1)
+			self.gui_undo.normal_color = LIGHT_GRAY
 		
+		if self.history.can_redo():
+			self.gui_redo.normal_color = WHITE
+		else:
+			self.gui_redo.normal_color = LIGHT_GRAY
+	
+	def push_command(self, cmd):
+		self.history.push(cmd)
 		self.gui_undo.normal_color = WHITE
 		self.gui_redo.normal_color = LIGHT_GRAY
+	
+	def undo_save(self, type, img1, img2, key, box=None):
+		"""
+		変化がなければ False
+		box: "sub" で img2 が img1 のこの範囲だけのとき
+		"""
+		if type == "sub":
+			cmd = PixelDiff.from_images(key, img1, img2, box)
+		else:
+			cmd = ImageReplace.from_images(key, img1, img2)
+		if cmd is None:
+			return False
+		self.push_command(cmd)
 		return True
 	
+	def begin_group(self):
+		"""commit_group までの操作を1回の undo にまとめ、画面の更新も最後に1回にする"""
+		self.history.begin()
+		self.doc.begin()
+	
+	def commit_group(self):
+		self.history.commit()
+		self.doc.end()
+	
 	def undo_load(self, redo=False):
-		length = len(self.layers)
-		
 		if redo:
-			self.undo_index += 1
-			undo = self.undo_list[self.undo_index]
+			self.history.redo().apply(self.doc)
 		else:
-			undo = self.undo_list[self.undo_index]
-			self.undo_index -= 1
-		
-		if undo.type == "sub":
-			lay = self.layers[undo.key]
-			if redo:
-				lay.image = ImageChops.subtract_modulo(lay.image, undo.image)
-			else:
-				lay.image = ImageChops.add_modulo(lay.image, undo.image)
-			lay.pil2tex()
-			self.selector_img(undo.key)
-		
-		elif undo.type == "image":
-			lay = self.layers[undo.key]
-			if redo:
-				lay.image = undo.image[1]
-			else:
-				lay.image = undo.image[0]
-			if undo.key == self.cur_key:
-				self.new_image(lay)
-			else:
-				lay.pil2tex()
-				self.selector_img(undo.key)
-		
-		elif (undo.type == "add_layer") ^ redo:
-			prev_number = self.layers[undo.key].number
-			self.layers[undo.key].node.remove_from_parent()
-			del self.layers[undo.key]
-			if undo.type == "add_layer":
-				self.next_key = undo.key
-				
-			if self.cur_key == undo.key:
-				if prev_number == 0:
-					next_number = prev_number + 1
-				else:
-					next_number = prev_number - 1
-			else:
-				next_number = None
-			
-			for key, lay in self.layers.items():
-				if lay.number == next_number:
-					self.cur_key = key
-					self.ov.node.z_position = lay.number + 0.5
-					self.new_image(lay)
-					
-				if lay.number >= prev_number:
-					lay.number -= 1
-					lay.node.z_position = lay.number
-			self.selector_remove(undo.key)
-			
-		else:
-			if undo.type == "add_layer":
-				lay = Layer(undo.image, length)
-				key = self.next_key
-			else:
-				lay = Layer(undo.image, undo.number)
-				key = undo.key
-			
-			for lay2 in self.layers.values():
-				if lay2.number >= lay.number:
-					lay2.number += 1
-					lay2.node.z_position = lay2.number
-			self.next_key = max(self.next_key, key + 1)
-				
-			self.img_bg.add_child(lay.node)
-			self.layers[key] = lay
-			self.selector_add(key)
+			self.history.undo().revert(self.doc)
 	
 	# ---:
 	
@@ -866,7 +1449,7 @@ class MyScene (Scene):
 			if not isinstance(self.img, GifImagePlugin.GifImageFile):
 				self.img = None
 			
-			if img.size[0] * img.size[1] > 409600 and self.display_alert:
+			if img.size[0] * img.size[1] > LARGE_IMAGE and self.display_alert:
 				c = dialogs.alert("Warning", "%sx%s" % img.size, "Open")
 				if not c == 1:
 					self.wait = False
@@ -874,14 +1457,17 @@ class MyScene (Scene):
 					return
 			
 			cul = self.current_layer()
-			if self.undo_save("image", cul.image, img, self.cur_key):
-				cul.image = img
-				self.new_image(cul)
-			
-			if self.img is not None:
-				for index in range(1, self.img.n_frames):
-					self.img.seek(index)
-					self.open_add(self.img.convert('RGBA'), cul.number + index)
+			self.begin_group()
+			try:
+				if self.undo_save("image", cul.image, img, self.cur_key):
+					self.doc.replace(self.cur_key, img)
+				
+				if self.img is not None:
+					for index in range(1, self.img.n_frames):
+						self.img.seek(index)
+						self.open_add(self.img.convert('RGBA'), cul.number + index)
+			finally:
+				self.commit_group()
 		
 		del self.img
 		self.wait = False
@@ -910,24 +1496,11 @@ class MyScene (Scene):
 		self.close_view(sender)
 	
 	def open_add(self, img, number):
-		undo = UndoData("add_layer")
-		undo.key = self.next_key
-		undo.image = img.copy()
-		self.undo_index += 1
-		self.undo_list[self.undo_index:] = [undo]
-		
-		lay = Layer(img, number)
-		key = self.next_key
+		# img はそのままレイヤーの画像になる (コピーしない)
+		cmd = AddLayer(self.next_key, number, image=img)
 		self.next_key += 1
-		
-		for key2, lay2 in self.layers.items():
-			if lay.number <= lay2.number:
-				lay2.number += 1
-				lay2.node.z_position = lay2.number
-			
-		self.layers[key] = lay
-		self.img_bg.add_child(lay.node)
-		self.selector_add(key)
+		self.push_command(cmd)
+		cmd.apply(self.doc)
 	
 	# ---:
 	
@@ -949,7 +1522,7 @@ class MyScene (Scene):
 	
 	def download_save(self, sender):
 		number = int(sender.name[-1])
-		self.img.save(f'files/save_{number}.png', format='png')
+		save_png(self.img, f'files/save_{number}.png')
 		sender.superview[f'img_save{number}'].image = pil2ui(self.img)
 	
 	def download_share(self, sender):
@@ -968,7 +1541,7 @@ class MyScene (Scene):
 			cul = self.current_layer()
 			frames = [lay.image.convert('RGBA') for lay in sorted(
 				self.layers.values(), key=lambda lay: lay.number
-				) if lay.image.size == cul.image.size]
+				) if lay.size == cul.size]
 			sc_gif(frames, time)
 	
 	# ---:
@@ -979,6 +1552,7 @@ class MyScene (Scene):
 		cul = self.current_layer()
 		self.img = cul.image
 		self.resize_mode = 'Resize'
+		self.resize_boxes = []
 		self.split_reverse = False
 		
 		w, h = self.img.size
@@ -988,22 +1562,24 @@ class MyScene (Scene):
 		self.add_view(v)
 		v.wait_modal()
 		
-		if isinstance(self.img, Image.Image):
-			img = self.img
-		else:
+		boxes = self.resize_boxes
+		if boxes:
 			if self.split_reverse:
-				self.img.reverse()
-			img = self.img[0]
-		
-		if self.undo_save("image", cul.image, img, self.cur_key):
-			cul.image = img
-			self.new_image(cul)
-		
-		if isinstance(self.img, list):
-			for index in range(1, len(self.img)):
-				self.open_add(self.img[index], cul.number + index)
-		
-		del self.img, self.resize_mode, self.split_reverse
+				boxes.reverse()
+			# 分割した2枚目からは元の画像から切り出して新しいレイヤーにする
+			frames = [cul.image.crop(box) for box in boxes[1:]]
+			cmd = Extent.from_image(self.cur_key, cul.image, boxes[0])
+			self.begin_group()
+			try:
+				if cmd is not None:
+					self.push_command(cmd)
+					cmd.apply(self.doc)
+				for index, img in enumerate(frames, 1):
+					self.open_add(img, cul.number + index)
+			finally:
+				self.commit_group()
+		
+		del self.img, self.resize_mode, self.resize_boxes, self.split_reverse
 		self.wait = False
 	
 	def resize_change(self, sender):
@@ -1039,61 +1615,39 @@ class MyScene (Scene):
 			v['lb_error'].alpha = 1
 			return
 		
+		# 切り抜く範囲 (元の画像の座標) だけを決め、画像は bt_resize で作る
+		boxes = self.resize_boxes
+		
 		# リサイズ
 		if self.resize_mode == 'Resize':
-			self.img = self.img.transform((w, h), Image.EXTENT, (x, y, w + x, h + y))
+			boxes.append((x, y, w + x, h + y))
 		
 		# 分割
+		elif self.resize_mode == 'SplitX':
+			div, mod = divmod(self.img.size[0] - x, w)
+			for i in range(div):
+				boxes.append((w * i + x, y, w * (i + 1) + x, h + y))
+			if mod:
+				boxes.append((w * div + x, y, w * div + mod + x, h + y))
+		
 		else:
-			img = self.img
-			self.img = []
-			
-			if self.resize_mode == 'SplitX':
-				div, mod = divmod(img.size[0] - x, w)
-				for i in range(div):
-					self.img.append(img.transform((w, h), Image.EXTENT, (
-						w * i + x,
-						y,
-						w * (i + 1) + x,
-						h + y
-					)))
-				if mod:
-					self.img.append(img.transform((mod, h), Image.EXTENT, (
-						w * div + x,
-						y,
-						w * div + mod + x,
-						h + y
-					)))
-			
-			else:
-				div, mod = divmod(img.size[1] - y, h)
-				for i in range(div):
-					self.img.append(img.transform((w, h), Image.EXTENT, (
-						x,
-						h * i + y,
-						w + x,
-						h * (i + 1) + y
-					)))
-				if mod:
-					self.img.append(img.transform((w, mod), Image.EXTENT, (
-						x,
-						h * div + y,
-						w + x,
-						h * div + mod + y
-					)))
-			
+			div, mod = divmod(self.img.size[1] - y, h)
+			for i in range(div):
+				boxes.append((x, h * i + y, w + x, h * (i + 1) + y))
+			if mod:
+				boxes.append((x, h * div + y, w + x, h * div + mod + y))
+		
 		self.close_view(sender)
 	
 	# ---:
 	
 	def bt_clear(self, bt):
-		cul = self.current_layer()
-		img = Image.new("RGBA", cul.image.size, CLEAR)
-		if self.undo_save("sub", cul.image, img, self.cur_key):
+		# 透明でない範囲だけを消す
+		cmd = Clear.from_image(self.cur_key, self.current_layer().image)
+		if cmd is not None:
 			self.sound_effect('ui:rollover3')
-			cul.image = img
-			cul.pil2tex()
-			self.selector_img(self.cur_key)
+			self.push_command(cmd)
+			cmd.apply(self.doc)
 	
 	def bt_zoom_in(self, bt):
 		if self.zoom != 128:
@@ -1137,6 +1691,8 @@ class MyScene (Scene):
 		v['sw_da'].value = self.display_alert
 		v['sw_at'].value = self.auto_tool
 		v['sw_ps'].value = self.play_sound
+		v['tx_as'].text = str(self.autosave)
+		v['sw_ai'].value = self.autosave_idle
 		
 		self.add_view(v)
 		v.wait_modal()
@@ -1165,6 +1721,11 @@ class MyScene (Scene):
 		self.display_alert = v['sw_da'].value
 		self.auto_tool = v['sw_at'].value
 		self.play_sound = v['sw_ps'].value
+		self.autosave_idle = v['sw_ai'].value
+		try:
+			self.autosave = max(0, int(v['tx_as'].text))
+		except ValueError:
+			pass
 		
 		if (not self.display_grid) or all(v < 0 for v in self.grid_size):
 			self.grid.alpha = 0
@@ -1211,27 +1772,20 @@ class MyScene (Scene):
 		for key, lay in self.layers.items():
 			self.layer_edit_add_view(key, lay)
 		
+		self.layer_editing = True
 		self.add_view(self.v)
 		self.v.wait_modal()
+		self.layer_editing = False
 		
-		if self.undo_index == -1:
-			self.gui_undo.normal_color = LIGHT_GRAY
-		else:
-			self.gui_undo.normal_color = WHITE
-		
-		if self.undo_index + 1 == len(self.undo_list):
-			self.gui_redo.normal_color = LIGHT_GRAY
-		else:
-			self.gui_redo.normal_color = WHITE
+		self.undo_color()
 		
 		for key, lay in self.layers.items():
 			if key == self.cur_key:
 				self.new_image(lay)
-				self.ov.node.z_position = lay.node.z_position + 0.5
 			else:
-				lay.pil2tex()
 				self.selector_img(key)
 		self.selector_update()
+		self.compositor.invalidate()
 		
 		del self.v
 		self.wait = False
@@ -1240,7 +1794,6 @@ class MyScene (Scene):
 		length = len(self.layers)
 		scroll = self.v['scroll']
 		scroll.content_size = (360, max(360, length * 80 + 20))
-		ui_img = pil2ui(lay.image)
 		
 		y = (length - 1 - lay.number) * 80 + 20
 		
@@ -1249,8 +1802,8 @@ class MyScene (Scene):
 		img_v.border_width = 1
 		img_v.name = f"img_{key}"
 		img_v.content_mode = ui.CONTENT_SCALE_ASPECT_FIT
-		img_v.image = ui_img
 		scroll.add_subview(img_v)
+		self.thumbnails.show(img_v, lay, THUMB_SIZE)
 		
 		bt_v = ui.Button()
 		bt_v.frame = (80, y, 128, 64)
@@ -1288,9 +1841,8 @@ class MyScene (Scene):
 	
 	def layer_edit_img(self, key):
 		lay = self.layers[key]
-		ui_img = pil2ui(lay.image)
 		img_v = self.v['scroll'][f"img_{key}"]
-		img_v.image = ui_img
+		self.thumbnails.show(img_v, lay, THUMB_SIZE)
 	
 	def layer_edit_pos(self, key, y):
 		scroll = self.v['scroll']
@@ -1303,6 +1855,27 @@ class MyScene (Scene):
 		al_v.frame = (216, y, 64, 64)
 		up_v.frame = (288, y, 64, 64)
 	
+	def layer_edit_layout(self):
+		length = len(self.layers)
+		scroll = self.v['scroll']
+		scroll.content_size = (360, max(360, length * 80 + 20))
+		for key, lay in self.layers.items():
+			self.layer_edit_pos(key, (length - 1 - lay.number) * 80 + 20)
+	
+	def layer_edit_remove_view(self, key):
+		scroll = self.v['scroll']
+		for name in ('img', 'layer', 'alpha', 'up'):
+			view = scroll[f'{name}_{key}']
+			if name == 'img':
+				self.thumbnails.forget(view)
+			scroll.remove_subview(view)
+	
+	def layer_edit_current(self, key):
+		bt_v = self.v['scroll'][f'layer_{key}']
+		bt_v.action = None
+		bt_v.border_width = 3
+		bt_v.border_color = '#77ff55'
+	
 	def layer_edit_select(self, sender):
 		bt_prev = self.v['scroll'][f'layer_{self.cur_key}']
 		self.cur_key = int(sender.name.split("_")[1])
@@ -1321,152 +1894,60 @@ class MyScene (Scene):
 		self.selector_alpha(key)
 		
 	def layer_edit_move(self, sender):
-		length = len(self.layers)
 		key = int(sender.name.split("_")[1])
 		prev_number = self.layers[key].number
-		
-		if (prev_number + 1) == length:
+		if (prev_number + 1) == len(self.layers):
 			return
-		next_number = prev_number + 1
-		
-		for key2, lay2 in self.layers.items():
-			if lay2.number in {next_number, prev_number}:
-				if key2 == key:
-					lay2.number += 1
-				else:
-					lay2.number -= 1
-				lay2.node.z_position = lay2.number
-				y = (length - 1 - lay2.number) * 80 + 20
-				self.layer_edit_pos(key2, y)
-		self.selector_update()
+		cmd = MoveLayer(key, prev_number, target=prev_number + 1)
+		self.push_command(cmd)
+		cmd.apply(self.doc)
 	
-	def layer_edit_add(self, sender, undo=None):
-		length = len(self.layers)
-		if undo:
-			if undo.type == "add_layer":
-				lay = Layer(undo.image, length)
-				key = self.next_key
-			else:
-				lay = Layer(undo.image, undo.number)
-				key = undo.key
-		else:
-			cul = self.current_layer()
-			if sender.name == 'bt_add':
-				text = "%sx%s" % cul.image.size
-				text = dialogs.input_alert("image size", "W x H", text)
-				if text is None:
+	def layer_edit_add(self, sender):
+		cul = self.current_layer()
+		if sender.name == 'bt_add':
+			text = "%sx%s" % cul.image.size
+			text = dialogs.input_alert("image size", "W x H", text)
+			if text is None:
+				return
+			text = text.replace(':', 'x')
+			if "x" in text:
+				split_text = text.split("x")
+				try:
+					w, h = [int(i) for i in split_text]
+				except ValueError:
 					return
-				text = text.replace(':', 'x')
-				if "x" in text:
-					split_text = text.split("x")
-					try:
-						w, h = [int(i) for i in split_text]
-					except ValueError:
-						return
-				else:
-					try:
-						w = int(text)
-						h = w
-					except ValueError:
-						return
-				img = Image.new("RGBA", (w, h), (0, 0, 0, 0))
-			
-			elif sender.name == 'bt_copy':
-				img = cul.image.copy()
-			
 			else:
-				sender.enabled = False
-				img = self.connect()
-				sender.enabled = True
-				if img is None:
+				try:
+					w = int(text)
+					h = w
+				except ValueError:
 					return
-			
-			undo = UndoData("add_layer")
-			undo.key = self.next_key
-			undo.image = img.copy()
-			self.undo_index += 1
-			self.undo_list[self.undo_index:] = [undo]
-			
-			lay = Layer(img, length)
-			key = self.next_key
-			
-		self.next_key = max(self.next_key, key + 1)
-		
-		for key2, lay2 in self.layers.items():
-			if lay2.number >= lay.number:
-				lay2.number += 1
-				lay2.node.z_position = lay2.number
-			y = (length - lay2.number) * 80 + 20
-			self.layer_edit_pos(key2, y)
-			
-		self.layers[key] = lay
-		self.img_bg.add_child(lay.node)
-		self.layer_edit_add_view(key, lay)
-		self.selector_add(key)
-	
-	def layer_edit_remove(self, sender, undo=None):
-		length = len(self.layers)
-		if length == 1:
-			return
+			img = Image.new("RGBA", (w, h), (0, 0, 0, 0))
 		
-		if undo:
-			key = undo.key
-			prev_number = self.layers[undo.key].number
-			self.layers[undo.key].node.remove_from_parent()
-			del self.layers[undo.key]
-			
-			if undo.type == "add_layer":
-				self.next_key = undo.key
-			
-		else:
-			key = self.cur_key
-			cul = self.current_layer()
-			prev_number = cul.number
-			
-			undo = UndoData("remove_layer")
-			undo.key = self.cur_key
-			undo.number = prev_number
-			undo.image = cul.image.copy()
-			self.undo_index += 1
-			self.undo_list[self.undo_index:] = [undo]
-			
-			cul.node.remove_from_parent()
-			del self.layers[self.cur_key]
+		elif sender.name == 'bt_copy':
+			# 複製は画像を共有し、どちらかが書き換えるときに初めてコピーする
+			img = share(cul.image)
 		
-		scroll = self.v['scroll']
-		img_v = scroll[f'img_{key}']
-		bt_v = scroll[f'layer_{key}']
-		al_v = scroll[f'alpha_{key}']
-		up_v = scroll[f'up_{key}']
-		scroll.remove_subview(img_v)
-		scroll.remove_subview(bt_v)
-		scroll.remove_subview(al_v)
-		scroll.remove_subview(up_v)
-		scroll.content_size = (360, max(360, (length - 1) * 80 + 20))
-		
-		if undo is None or self.cur_key == undo.key:
-			if prev_number == 0:
-				next_number = prev_number + 1
-			else:
-				next_number = prev_number - 1
 		else:
-			next_number = None
+			sender.enabled = False
+			img = self.connect()
+			sender.enabled = True
+			if img is None:
+				return
 		
-		for key2, lay2 in self.layers.items():
-			if lay2.number == next_number:
-				self.cur_key = key2
-				bt_v = scroll[f'layer_{key2}']
-				bt_v.action = None
-				bt_v.border_width = 3
-				bt_v.border_color = '#77ff55'
-				
-			if lay2.number > prev_number:
-				lay2.number -= 1
-				lay2.node.z_position = lay2.number
-			else:
-				y = (length - 2 - lay2.number) * 80 + 20
-				self.layer_edit_pos(key2, y)
-		self.selector_remove(key)
+		cmd = AddLayer(self.next_key, len(self.layers), image=img)
+		self.next_key += 1
+		self.push_command(cmd)
+		cmd.apply(self.doc)
+	
+	def layer_edit_remove(self, sender):
+		if len(self.layers) == 1:
+			return
+		cul = self.current_layer()
+		# 消したレイヤーの画像はもう書き換えられないので、コピーせずに持つ
+		cmd = RemoveLayer(self.cur_key, cul.number, image=cul.image)
+		self.push_command(cmd)
+		cmd.apply(self.doc)
 	
 	def layer_edit_bgc(self, sender):
 		scroll = self.v['scroll']
@@ -1481,40 +1962,14 @@ class MyScene (Scene):
 				v.border_color = bd_color
 	
 	def layer_edit_undo(self, sender):
-		redo = sender.name == 'bt_redo'
-			
-		if redo:
-			if self.undo_index + 1 == len(self.undo_list):
-				return
-			self.undo_index += 1
-			undo = self.undo_list[self.undo_index]
-		else:
-			if self.undo_index == -1:
-				return
-			undo = self.undo_list[self.undo_index]
-			self.undo_index -= 1
-		
-		if undo.type == "sub":
-			lay = self.layers[undo.key]
-			if redo:
-				lay.image = ImageChops.subtract_modulo(lay.image, undo.image)
-			else:
-				lay.image = ImageChops.add_modulo(lay.image, undo.image)
-			self.layer_edit_img(undo.key)
-		
-		elif undo.type == "image":
-			lay = self.layers[undo.key]
-			if redo:
-				lay.image = undo.image[1]
-			else:
-				lay.image = undo.image[0]
-			self.layer_edit_img(undo.key)
-			
-		elif (undo.type == "add_layer") ^ redo:
-			self.layer_edit_remove(sender, undo)
-			
+		if sender.name == 'bt_redo':
+			cmd = self.history.redo()
+			if cmd is not None:
+				cmd.apply(self.doc)
 		else:
-			self.layer_edit_add(sender, undo)
+			cmd = self.history.undo()
+			if cmd is not None:
+				cmd.revert(self.doc)
 	
 	# ---:
 	
@@ -1540,8 +1995,6 @@ class MyScene (Scene):
 		for lay in self.layers.values():
 			self.img_list[lay.number] = [lay.image, False]
 			
-			ui_img = pil2ui(lay.image)
-			
 			y = (length - 1 - lay.number) * 80 + 8
 			
 			img_v = ui.ImageView()
@@ -1550,8 +2003,8 @@ class MyScene (Scene):
 			img_v.border_width = 1
 			img_v.name = f"img_{lay.number}"
 			img_v.content_mode = ui.CONTENT_SCALE_ASPECT_FIT
-			img_v.image = ui_img
 			scroll.add_subview(img_v)
+			self.thumbnails.show(img_v, lay, THUMB_SIZE)
 			
 			y += 8
 			
@@ -1580,6 +2033,9 @@ class MyScene (Scene):
 		v.wait_modal()
 		
 		img = self.img
+		if any(img is src for src, _ in self.img_list):
+			# 1枚だけならレイヤーの画像そのもの (複製と同じく共有にする)
+			img = share(img)
 		del self.img_list, self.img, self.connect_mode, self.connect_reverse
 		return img
 	
@@ -1749,6 +2205,8 @@ class MyScene (Scene):
 			tx += '画像ファイルが見つかりません。\n'
 			plts_img = Image.open(sample_path)
 		
+		# パレット画像 ("P") で保存されていることもある
+		plts_img = plts_img.convert('RGBA')
 		for y in range(plts_img.size[1]):
 			img = plts_img.transform((8, 1), Image.EXTENT, (0, y, 8, y))
 			data = img.getdata()
@@ -1764,6 +2222,8 @@ class MyScene (Scene):
 			tx += '画像ファイルが見つかりません。\n'
 			plts_img = Image.open(sample_path)
 		
+		# パレット画像 ("P") で保存されていることもある
+		plts_img = plts_img.convert('RGBA')
 		for y in range(plts_img.size[1]):
 			img = plts_img.transform((8, 1), Image.EXTENT, (0, y, 8, y))
 			data = img.getdata()
@@ -1786,14 +2246,14 @@ class MyScene (Scene):
 			data.extend(list(plt.values()))
 		img = Image.new("RGBA", (8, len(self.plts_lcl) - 1), CLEAR)
 		img.putdata(data)
-		img.save(f'files/save_data/{self.folder_name}/palettes.png')
+		save_png(img, f'files/save_data/{self.folder_name}/palettes.png')
 		
 		data.clear()
 		for plt in self.plts_glb:
 			data.extend(list(plt.values()))
 		img = Image.new("RGBA", (8, len(self.plts_glb)), CLEAR)
 		img.putdata(data)
-		img.save('files/palettes.png')
+		save_png(img, 'files/palettes.png')
 		
 		self.set_palette(self.plt)
 		
@@ -2060,15 +2520,22 @@ class MyScene (Scene):
 		
 		alphas = {key: lay.node.alpha for key, lay in self.layers.items()}
 		
+		# アニメーション中は合成せずに各レイヤーを並べる
+		self.compositor.suspend()
+		cul = self.current_layer()
 		for key, lay in self.layers.items():
 			lay.node.alpha = 0.0
 			self.selector_alpha(key)
+			if lay is not cul:
+				lay.pil2tex()
+				self.img_bg.add_child(lay.node)
+		del cul
 		
 		def animation():
 			cul = self.current_layer()
 			lays = [lay for lay in sorted(
 				self.layers.items(), key=lambda lay: lay[1].number
-				) if lay[1].image.size == cul.image.size]
+				) if lay[1].size == cul.size]
 			del cul
 			while True:
 				for key, lay in lays:
@@ -2088,9 +2555,15 @@ class MyScene (Scene):
 		v.wait_modal()
 		
 		self.remove_action('anim')
+		cul = self.current_layer()
 		for key, a in alphas.items():
-			self.layers[key].node.alpha = a
+			lay = self.layers[key]
+			lay.node.alpha = a
 			self.selector_alpha(key)
+			if lay is not cul:
+				lay.node.remove_from_parent()
+		del cul
+		self.compositor.resume()
 		
 		del self.anim
 		self.wait = False
@@ -2165,9 +2638,10 @@ class MyScene (Scene):
 		img_v.frame = (0, 0, l * 1.2, l)
 		img_v.name = f'image'
 		img_v.content_mode = ui.CONTENT_SCALE_ASPECT_FIT
-		img_v.image = pil2ui(lay.image)
 		img_v.touch_enabled = False
 		bt_v.add_subview(img_v)
+		self.thumbnails.show(img_v, lay, THUMB_SIZE)
+		self.selector_versions[key] = lay.version
 		
 		lb_v = ui.Label()
 		lb_v.frame = (0, l * 0.6, l * 1.2, l * 0.4)
@@ -2183,13 +2657,17 @@ class MyScene (Scene):
 	def selector_remove(self, key):
 		bt_v = self.lay_selector[f'layer_{key}']
 		self.lay_selector.remove_subview(bt_v)
+		self.thumbnails.forget(bt_v['image'])
+		self.selector_versions.pop(key, None)
 		self.selector_update()
 	
 	def selector_img(self, key):
-		img_v = self.lay_selector[f'layer_{key}']['image']
 		lay = self.layers[key]
-		ui_img = pil2ui(lay.image)
-		img_v.image = ui_img
+		if self.selector_versions.get(key) == lay.version:
+			return
+		self.selector_versions[key] = lay.version
+		img_v = self.lay_selector[f'layer_{key}']['image']
+		self.thumbnails.show(img_v, lay, THUMB_SIZE)
 	
 	def selector_alpha(self, key):
 		lb_v = self.lay_selector[f'layer_{key}']['alpha']
@@ -2229,7 +2707,6 @@ class MyScene (Scene):
 				self.cur_key = key
 				cul = self.current_layer()
 				self.new_image(cul)
-				self.ov.node.z_position = cul.node.z_position + 0.5
 	
 	# ---:
 	
@@ -2626,17 +3103,16 @@ class MyScene (Scene):
 	
 	def new_image(self, lay):
 		lay.pil2tex()
+		self.compositor.set_active(lay)
+		self.ov.node.z_position = lay.number + 0.5
 		
-		self.img_bg.size = lay.node.size
+		self.img_bg.size = lay.image.size
 		self.img_bg.scale = self.zoom
-		self.ov.node.size = lay.node.size
 		self.set_pos()
 		self.set_grid()
 		self.selector_img(self.cur_key)
 		if self.ov.image.size != lay.image.size:
-			self.ov.image = Image.new("RGBA", lay.image.size, CLEAR)
-			self.ov.pil2tex()
-			self.draw_ov = ImageDraw.Draw(self.ov.image)
+			self.ov.resize(lay.image.size)
 	
 	def set_pos(self):
 		w = self.img_bg.frame.w
@@ -2650,31 +3126,66 @@ class MyScene (Scene):
 		if (grid_w < 0 and grid_h < 0) or not self.display_grid:
 			return
 		cul = self.current_layer()
+		img_w, img_h = cul.image.size
+		zoom = self.zoom
 		
-		thin_path = ui.Path.rect(0, 0, 0, 0)
-		thin_path.line_width = 0.15
-		thick_path = ui.Path.rect(0, 0, 0, 0)
-		thick_path.line_width = 0.6
-		
-		mag = max(1, 4 // self.zoom)  # magnification
+		mag = max(1, 4 // zoom)  # magnification
 		if grid_w < 16 or grid_h < 16:
 			grid_w *= mag
 			grid_h *= mag
 		
-		# 変更しない
+		# 画面に見えている範囲 (画像のピクセル単位)
 		size_w, size_h = self.size
-		min_x = max(0, min(size_w, self.img_bg.frame.min_x))
-		max_x = max(0, min(size_w, self.img_bg.frame.max_x))
-		min_y = max(0, min(size_h, size_h - self.img_bg.frame.max_y))
-		max_y = max(0, min(size_h, size_h - self.img_bg.frame.min_y))
+		left = self.img_bg.position.x
+		top = self.img_bg.position.y
+		vx0 = max(0, math.floor(-left / zoom))
+		vx1 = min(img_w, math.ceil((size_w - left) / zoom))
+		vy0 = max(0, math.floor((top - size_h) / zoom))
+		vy1 = min(img_h, math.ceil(top / zoom))
+		
+		# 画面の 1/4 ごとに区切り、少し広めに作っておく
+		# 区切りを越えない移動なら作り直さずにずらすだけ
+		step_x = max(mag, math.ceil(size_w / 4 / zoom))
+		step_y = max(mag, math.ceil(size_h / 4 / zoom))
+		rx0 = vx0 // step_x * step_x
+		rx1 = min(img_w, -(-vx1 // step_x) * step_x)
+		ry0 = vy0 // step_y * step_y
+		ry1 = min(img_h, -(-vy1 // step_y) * step_y)
+		
+		key = (cul.image.size, zoom, self.grid_size, (rx0, ry0, rx1, ry1))
+		if key != self.grid_key:
+			paths = self.grid_cache.get(key)
+			if paths is None:
+				paths = self.grid_paths(
+					zoom, mag, grid_w, grid_h, (rx0, ry0, rx1, ry1))
+				self.grid_cache[key] = paths
+				while len(self.grid_cache) > 8:
+					self.grid_cache.popitem(last=False)
+			else:
+				self.grid_cache.move_to_end(key)
+			self.grid.path, self.thick_grid.path = paths
+			self.grid_key = key
+			self.grid_origin = (rx0 * zoom, ry0 * zoom)
+		
+		ox, oy = self.grid_origin
+		self.grid.position = (left + ox, top - oy)
+	
+	@staticmethod
+	def grid_paths(zoom, mag, grid_w, grid_h, region):
+		"""画像の左上を原点にした、region の中だけのグリッド線"""
+		rx0, ry0, rx1, ry1 = region
+		min_x, min_y = rx0 * zoom, ry0 * zoom
+		max_x, max_y = rx1 * zoom, ry1 * zoom
+		
+		# 原点を region の左上に合わせる
+		thin_path = ui.Path.rect(min_x, min_y, 0, 0)
+		thin_path.line_width = 0.15
+		thick_path = ui.Path.rect(min_x, min_y, 0, 0)
+		thick_path.line_width = 0.6
 		
 		if 0 <= grid_w:
-			for px in range(mag, cul.image.size[0], mag):
-				x = self.img_bg.position.x + self.zoom * px
-				if x < 0:
-					continue
-				elif x > size_w:
-					break
+			for px in range(max(mag, -(-rx0 // mag) * mag), rx1, mag):
+				x = zoom * px
 				if grid_w and not px % grid_w:
 					thick_path.move_to(x, min_y)
 					thick_path.line_to(x, max_y)
@@ -2683,12 +3194,8 @@ class MyScene (Scene):
 					thin_path.line_to(x, max_y)
 		
 		if 0 <= grid_h:
-			for py in range(mag, cul.image.size[1], mag):
-				y = self.size.h - self.img_bg.position.y + self.zoom * py
-				if y < 0:
-					continue
-				elif y > size_h:
-					break
+			for py in range(max(mag, -(-ry0 // mag) * mag), ry1, mag):
+				y = zoom * py
 				if grid_h and not py % grid_h:
 					thick_path.move_to(min_x, y)
 					thick_path.line_to(max_x, y)
@@ -2696,9 +3203,7 @@ class MyScene (Scene):
 					thin_path.move_to(min_x, y)
 					thin_path.line_to(max_x, y)
 		
-		self.grid.path = thin_path
-		self.thick_grid.path = thick_path
-		self.grid.position = (0, size_h)
+		return thin_path, thick_path
 	
 	def grid_color(self):
 		if sum(self.img_bg.color[0:3]) > 0.5:
@@ -1,9 +1,9 @@
-from PIL import Image, ImageChops
+from PIL import Image
 
+from mym.premul import PremulBuffer, premultiply
 
-def image4scene(img: Image.Image) -> Image.Image:
-	r, g, b, a = img.split()
-	r = ImageChops.multiply(r, a)
-	g = ImageChops.multiply(g, a)
-	b = ImageChops.multiply(b, a)
-	return Image.merge("RGBA", (r, g, b, a))
+
+def image4scene(
+		img: Image.Image, box: tuple = None,
+		buffer: PremulBuffer = None) -> Image.Image:
+	return premultiply(img, box, buffer)
@@ -1,16 +1,16 @@
 from PIL import Image
-import io
 import scene
 import ui
 
+from mym.img2tex import get_default_encoder, img2tex, img2ui
+from ._image4scene import image4scene
+
 
 def pil2ui(img: Image.Image) -> ui.Image:
-	with io.BytesIO() as f:
-		img.save(f, format='PNG')
-		buffer_img = f.getvalue()
-	return ui.Image.from_data(buffer_img)
+	return img2ui(img)
 
 
 def pil2tex(img: Image.Image) -> scene.Texture:
-	ui_img = pil2ui(img)
-	return scene.Texture(ui_img)
+	if get_default_encoder().premultiplied:
+		img = image4scene(img)
+	return img2tex(img)
@@ -0,0 +1,50 @@
+import queue
+import threading
+
+from .history import release
+from .project import write_project
+
+
+__all__ = ["Autosaver"]
+
+
+class Autosaver:
+	"""
+	プロジェクトの書き出し (PNG の圧縮とファイルの置き換え) を別スレッドで行う
+	頼むのはシーンのスレッドで控えた内容だけ (画像は share 済みのもの 書き終えたら release する)
+	error: 最後に失敗したときの例外 (見た側が None に戻す)
+	"""
+	def __init__(self):
+		self.busy = False
+		self.error = None
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def save(self, folder, images, data):
+		self.busy = True
+		self._queue.put((folder, images, data))
+
+	def wait(self):
+		"""頼んだ保存が終わるまで待つ"""
+		self._queue.join()
+
+	def stop(self):
+		"""頼んだ保存を済ませてからスレッドを終える"""
+		self._queue.put(None)
+
+	def _run(self):
+		while True:
+			job = self._queue.get()
+			if job is None:
+				self._queue.task_done()
+				return
+			try:
+				write_project(*job)
+			except Exception as e:
+				self.error = e
+			finally:
+				for img in job[1].values():
+					release(img)
+				self.busy = False
+				self._queue.task_done()
@@ -0,0 +1,167 @@
+from PIL import Image
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from .project import LazyImage, layer_file, load_layers, write_project
+
+
+__all__ = [
+	"EXTENSION", "RAW", "ZLIB", "save", "Container",
+	"folder_to_container", "container_to_folder"]
+
+
+# プロジェクトを1つのファイルにまとめた形式 (.px3)
+#	MAGIC | ヘッダーの長さ (u32) | ヘッダー (JSON) | レイヤーのデータ
+# ヘッダーは data.json と同じ内容で、レイヤーごとに
+#	"mode", "codec", "chunks": [[位置, 長さ, 行数], ...]
+# を足したもの (位置はレイヤーのデータの先頭から)
+# レイヤーは CHUNK_ROWS 行ずつに分けて、そのまま (RAW) か zlib で置く
+
+MAGIC = b"PX3C\x01"
+EXTENSION = ".px3"
+RAW = "raw"
+ZLIB = "zlib"
+CHUNK_ROWS = 64
+
+_LENGTH = struct.Struct("<I")
+
+
+def _chunks(img, codec, level):
+	data = img.tobytes()
+	stride = img.size[0] * len(img.getbands())
+	h = img.size[1]
+	for y in range(0, h, CHUNK_ROWS):
+		rows = min(CHUNK_ROWS, h - y)
+		chunk = data[y * stride:(y + rows) * stride]
+		if codec == ZLIB:
+			chunk = zlib.compress(chunk, level)
+		yield chunk, rows
+
+
+def save(path: str, data: dict, images: dict, codec: str = ZLIB, level: int = 1):
+	"""
+	data: data.json と同じ形 (レイヤーの "file", "y" は使わない)
+	images: {キー: 画像}
+	"""
+	header = {k: v for k, v in data.items() if k not in ("layers", "journal")}
+	layers = {}
+	payload = []
+	offset = 0
+	for k, lay_dict in data["layers"].items():
+		img = images[int(k)]
+		chunks = []
+		for chunk, rows in _chunks(img, codec, level):
+			chunks.append([offset, len(chunk), rows])
+			payload.append(chunk)
+			offset += len(chunk)
+		lay_dict = {n: v for n, v in lay_dict.items() if n not in ("file", "y")}
+		lay_dict.update({
+			"w": img.size[0], "h": img.size[1], "mode": img.mode,
+			"codec": codec, "chunks": chunks})
+		layers[str(k)] = lay_dict
+	header["layers"] = layers
+	header = json.dumps(header).encode()
+
+	tmp = path + ".tmp"
+	with open(tmp, "wb") as f:
+		f.write(MAGIC)
+		f.write(_LENGTH.pack(len(header)))
+		f.write(header)
+		for chunk in payload:
+			f.write(chunk)
+	os.replace(tmp, path)
+
+
+class _ContainerImage(LazyImage):
+	"""Container のレイヤー (開くときにそのレイヤーだけを読む)"""
+	__slots__ = ['container', 'key']
+
+	def __init__(self, container, key):
+		lay_dict = container.data["layers"][str(key)]
+		LazyImage.__init__(self, (lay_dict["w"], lay_dict["h"]))
+		self.container = container
+		self.key = key
+
+	def open(self):
+		return self.container.image(self.key)
+
+
+class Container:
+	"""
+	.px3 を mmap して読む
+	data: ヘッダー (data.json と同じ形)
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+		self.file = open(path, "rb")
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.map[:len(MAGIC)] != MAGIC:
+			self.close()
+			raise ValueError(f"not a px3 container: {path}")
+		pos = len(MAGIC)
+		n = _LENGTH.unpack_from(self.map, pos)[0]
+		pos += _LENGTH.size
+		self.data = json.loads(self.map[pos:pos + n])
+		self.start = pos + n
+
+	def image(self, key) -> Image.Image:
+		"""key のレイヤーだけを読む"""
+		lay_dict = self.data["layers"][str(key)]
+		parts = []
+		for offset, length, rows in lay_dict["chunks"]:
+			start = self.start + offset
+			chunk = self.map[start:start + length]
+			if lay_dict["codec"] == ZLIB:
+				chunk = zlib.decompress(chunk)
+			parts.append(chunk)
+		size = (lay_dict["w"], lay_dict["h"])
+		return Image.frombytes(lay_dict["mode"], size, b"".join(parts))
+
+	def images(self, lazy: bool = False) -> dict:
+		"""{キー: 画像} lazy なら開くまで読まない (Layer にそのまま渡せる)"""
+		if lazy:
+			return {int(k): _ContainerImage(self, int(k)) for k in self.data["layers"]}
+		return {int(k): self.image(k) for k in self.data["layers"]}
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def folder_to_container(folder: str, path: str, codec: str = ZLIB):
+	"""プロジェクトのフォルダ (data.json と画像) を .px3 にする"""
+	with open(os.path.join(folder, "data.json")) as f:
+		data = json.load(f)
+	images, missing = load_layers(folder, data)
+	save(path, data, images, codec)
+	return missing
+
+
+def container_to_folder(path: str, folder: str):
+	"""
+	.px3 をプロジェクトのフォルダに戻す
+	履歴は入っていないので、フォルダの履歴は次に開いたときに捨てられる
+	"""
+	with Container(path) as c:
+		data = c.data
+		images = c.images()
+	number = data.get("save", 0) + 1
+	files = {}
+	for k, lay_dict in data["layers"].items():
+		name = layer_file(k, number)
+		files[name] = images[int(k)]
+		for n in ("mode", "codec", "chunks"):
+			del lay_dict[n]
+		lay_dict["file"] = name
+	data["save"] = number
+	write_project(folder, files, data)
@@ -0,0 +1,738 @@
+from PIL import Image, ImageChops
+import threading
+import weakref
+import zlib
+
+
+__all__ = [
+	"PackedImage", "pack", "unpack", "payload_nbytes", "History",
+	"Document", "Command", "PixelDiff", "ImageReplace",
+	"AddLayer", "RemoveLayer", "MoveLayer", "Extent", "Clear", "Group",
+	"COMMANDS", "make_command", "share", "release", "is_shared",
+	"bands_bbox"]
+
+
+class PackedImage:
+	"""zlib で圧縮した PIL.Image"""
+	__slots__ = ['mode', 'size', 'data']
+
+	def __init__(self, img: Image.Image, level: int = 1):
+		self.mode = img.mode
+		self.size = img.size
+		self.data = zlib.compress(img.tobytes(), level)
+
+	@classmethod
+	def from_data(cls, mode: str, size: tuple, data: bytes):
+		"""圧縮済みのバイト列から作る"""
+		self = cls.__new__(cls)
+		self.mode = mode
+		self.size = tuple(size)
+		self.data = data
+		return self
+
+	def unpack(self) -> Image.Image:
+		return Image.frombytes(self.mode, self.size, zlib.decompress(self.data))
+
+
+def pack(obj):
+	"""履歴の中身 (Image | tuple | None) の画像をすべて圧縮する"""
+	if isinstance(obj, Image.Image):
+		return PackedImage(obj)
+	if isinstance(obj, tuple):
+		return tuple(pack(v) for v in obj)
+	return obj
+
+
+def unpack(obj):
+	if isinstance(obj, PackedImage):
+		return obj.unpack()
+	if isinstance(obj, tuple):
+		return tuple(unpack(v) for v in obj)
+	return obj
+
+
+def payload_nbytes(obj) -> int:
+	if isinstance(obj, PackedImage):
+		return len(obj.data)
+	if isinstance(obj, Image.Image):
+		w, h = obj.size
+		return w * h * len(obj.getbands())
+	if isinstance(obj, tuple):
+		return sum(payload_nbytes(v) for v in obj)
+	return 0
+
+
+class History:
+	"""
+	undo/redo の履歴 件数ではなくバイト数 (budget) で制限する
+	項目の中身は .image に置く (Image | tuple | None)
+	今の位置から keep 件より離れた項目は圧縮し、取り出すときに戻す
+	index: 次に undo する項目 (-1 なら undo できない)
+	journal: push, undo, redo を書き残す先 (mym.journal.Journal | None)
+	begin から commit までに push した項目は1つの Group になる
+	keyframe で interval 件ごとにレイヤーの画像を控え (最大 keyframes 個)、
+	jump で離れた位置へ移るときに使う 控えも budget に数え、項目より先に捨てる
+	"""
+
+	def __init__(
+			self, budget: int = 64 * 1024 * 1024, keep: int = 4,
+			journal=None, interval: int = 32, keyframes: int = 4):
+		self.budget = budget
+		self.keep = keep
+		self.journal = journal
+		self.interval = interval
+		self.max_keyframes = keyframes
+		self.entries = []
+		self.sizes = []
+		self.index = -1
+		self.group = None
+		self.depth = 0
+		self.keyframes = []  # (index, {key: 画像}) index の項目まで適用した状態
+
+	def __len__(self):
+		return len(self.entries)
+
+	@property
+	def nbytes(self) -> int:
+		"""今の履歴が使っているバイト数 (控えを含む)"""
+		return sum(self.sizes) + self._keyframe_nbytes()
+
+	def _keyframe_nbytes(self) -> int:
+		# 変わっていないレイヤーは控えどうしで同じ画像なので1回だけ数える
+		images = {id(img): img for _, kf in self.keyframes for img in kf.values()}
+		return sum(payload_nbytes(img) for img in images.values())
+
+	def can_undo(self) -> bool:
+		return self.index >= 0
+
+	def can_redo(self) -> bool:
+		return self.index + 1 < len(self.entries)
+
+	def clear(self):
+		self.entries.clear()
+		self.sizes.clear()
+		self._keep_keyframes([])
+		self.index = -1
+
+	def restore(self, entries, index):
+		"""保存してあった履歴に置き換える (journal には書かない)"""
+		self.entries = list(entries)
+		self.sizes = [payload_nbytes(entry.image) for entry in self.entries]
+		self.index = index
+		self._keep_keyframes([])
+		self.compact()
+
+	def begin(self):
+		"""ここから commit までの push をまとめる (入れ子にできる)"""
+		if self.depth == 0:
+			self.group = Group()
+			if self.journal is not None:
+				self.journal.begin()
+		self.depth += 1
+
+	def commit(self):
+		"""まとめた項目を1件として積む (空なら何も積まない)"""
+		self.depth -= 1
+		if self.depth:
+			return
+		group = self.group
+		self.group = None
+		if self.journal is not None:
+			self.journal.commit()
+		if group.commands:
+			self._append(group)
+
+	def push(self, entry):
+		"""entry を追加する (redo できた項目は捨てる)"""
+		if self.group is not None:
+			self.group.commands.append(entry)
+			if self.journal is not None:
+				self.journal.push(entry)
+			return
+		if self.journal is not None:
+			self.journal.push(entry)
+		self._append(entry)
+
+	def _append(self, entry):
+		del self.entries[self.index + 1:]
+		del self.sizes[self.index + 1:]
+		self._keep_keyframes([kf for kf in self.keyframes if kf[0] <= self.index])
+		self.entries.append(entry)
+		self.sizes.append(payload_nbytes(entry.image))
+		self.index += 1
+		self.compact()
+
+	def undo(self):
+		"""undo する項目を返す (なければ None)"""
+		if not self.can_undo():
+			return None
+		entry = self._take(self.index)
+		self.index -= 1
+		if self.journal is not None:
+			self.journal.undo()
+		self.compact()
+		return entry
+
+	def redo(self):
+		if not self.can_redo():
+			return None
+		self.index += 1
+		entry = self._take(self.index)
+		if self.journal is not None:
+			self.journal.redo()
+		self.compact()
+		return entry
+
+	def keyframe(self, doc):
+		"""
+		今の状態を控える (近くに控えがあるか、控えると budget を超えるなら何もしない)
+		画像はコピーせずに share する (次に書き換えるレイヤーが複製する)
+		まだ開いていないレイヤー (.lazy) は開かずに控えから外す
+		(jump はそのレイヤーを変えた範囲では控えを使わない)
+		"""
+		if self.group is not None:
+			return
+		for index, _ in self.keyframes:
+			if abs(index - self.index) < self.interval:
+				return
+		images = {
+			key: lay.image for key, lay in doc.layers.items()
+			if getattr(lay, "lazy", None) is None}
+		# すぐ捨てることになる控えは作らない (share すると次の書き込みが複製になる)
+		if sum(self.sizes) + payload_nbytes(tuple(images.values())) > self.budget:
+			return
+		for img in images.values():
+			share(img)
+		self.keyframes.append((self.index, images))
+		self.keyframes.sort(key=lambda kf: kf[0])
+		while len(self.keyframes) > self.max_keyframes:
+			self._drop_keyframe()
+		self.compact()
+
+	def _drop_keyframe(self):
+		# 今の位置から一番遠いものを捨てる
+		far = max(self.keyframes, key=lambda kf: abs(kf[0] - self.index))
+		self._keep_keyframes([kf for kf in self.keyframes if kf is not far])
+
+	def _keep_keyframes(self, keyframes):
+		"""控えを keyframes にする 捨てた控えの画像は release する"""
+		kept = {id(images) for _, images in keyframes}
+		for _, images in self.keyframes:
+			if id(images) not in kept:
+				for img in images.values():
+					release(img)
+		self.keyframes = keyframes
+
+	def jump(self, doc, target: int) -> bool:
+		"""
+		target (-1 なら何もしていない状態) まで一度に undo/redo する
+		近くに控えがあり、間がレイヤーの画像だけを変える項目ならそこから戻す
+		(控えにないレイヤーを変えた範囲なら、1件ずつやり直す)
+		画面の更新は doc.begin, doc.end で最後に1回
+		"""
+		target = max(-1, min(len(self.entries) - 1, target))
+		start = self.index
+		if target == start:
+			return False
+		base = None
+		best = abs(target - start)
+		for index, images in self.keyframes:
+			lo = min(index, start, target)
+			hi = max(index, start, target)
+			if abs(target - index) + 1 < best and all(
+					self.entries[i].pixel for i in range(lo + 1, hi + 1)) and all(
+					self.entries[i].key in images
+					for i in range(min(index, start) + 1, max(index, start) + 1)):
+				base = index, images
+				best = abs(target - index) + 1
+
+		doc.begin()
+		try:
+			if base is not None:
+				index, images = base
+				# 控えから今までに変わったレイヤーだけを控えに戻す
+				keys = {
+					self.entries[i].key
+					for i in range(min(index, start) + 1, max(index, start) + 1)}
+				for key in keys:
+					# 控えにも残るので、レイヤーとは共有になる
+					doc.replace(key, share(images[key]))
+				self.index = index
+			while self.index < target:
+				self.index += 1
+				self._take(self.index).apply(doc)
+			while self.index > target:
+				self._take(self.index).revert(doc)
+				self.index -= 1
+		finally:
+			doc.end()
+
+		if self.journal is not None:
+			for _ in range(target - start):
+				self.journal.redo()
+			for _ in range(start - target):
+				self.journal.undo()
+		self.compact()
+		return True
+
+	def _take(self, i):
+		entry = self.entries[i]
+		entry.image = unpack(entry.image)
+		self.sizes[i] = payload_nbytes(entry.image)
+		return entry
+
+	def compact(self):
+		"""離れた項目を圧縮し、budget を超えたら控えを、それでも超えれば古い項目から捨てる"""
+		for i, entry in enumerate(self.entries):
+			# undo で使う index と redo で使う index + 1 の周り
+			if not self.index - self.keep < i <= self.index + self.keep:
+				entry.image = pack(entry.image)
+			# レイヤーに渡して空になった項目もあるので数え直す
+			self.sizes[i] = payload_nbytes(entry.image)
+
+		total = sum(self.sizes)
+		while self.keyframes and total + self._keyframe_nbytes() > self.budget:
+			self._drop_keyframe()
+		count = 0
+		# 最新の1件は残す
+		while total > self.budget and count < self.index:
+			total -= self.sizes[count]
+			count += 1
+		if count:
+			del self.entries[:count]
+			del self.sizes[:count]
+			self.index -= count
+			self._keep_keyframes([
+				(index - count, images) for index, images in self.keyframes
+				if index - count >= -1])
+
+
+# ---:
+
+
+def bands_bbox(img: Image.Image):
+	"""すべてのチャンネルを見た getbbox (RGBA の getbbox はアルファしか見ないことがある)"""
+	box = None
+	for band in img.split():
+		b = band.getbbox()
+		if b is None:
+			continue
+		if box is None:
+			box = b
+		else:
+			box = (
+				min(box[0], b[0]), min(box[1], b[1]),
+				max(box[2], b[2]), max(box[3], b[3]))
+	return box
+
+
+# 複数のレイヤー (や履歴) が持っている画像 id -> 画像
+_shared = weakref.WeakValueDictionary()
+# id -> 持ち主の数 (_shared にある間だけ意味を持つ)
+_owners = {}
+# 自動保存のスレッドも release する
+_owners_lock = threading.Lock()
+
+
+def share(img: Image.Image) -> Image.Image:
+	"""
+	img の持ち主を1つ増やす (コピーせずにレイヤーを複製するときなど)
+	持ち主が2つ以上の画像はその場では書き換えず、書く側が own で複製して release する
+	"""
+	i = id(img)
+	with _owners_lock:
+		if _shared.get(i) is img:
+			_owners[i] += 1
+			return img
+		if len(_owners) > 2 * len(_shared) + 64:
+			# 共有のまま消えた画像の数を捨てる
+			for k in [k for k in _owners if k not in _shared]:
+				del _owners[k]
+		_shared[i] = img
+		_owners[i] = 2
+	return img
+
+
+def release(img: Image.Image):
+	"""
+	持ち主を1つ減らす (own で複製したとき、控えや保存が使い終わったとき)
+	残りが1つなら印を外し、その持ち主はもう複製せずに書き換えられる
+	"""
+	i = id(img)
+	with _owners_lock:
+		if _shared.get(i) is not img:
+			return
+		n = _owners[i] - 1
+		if n <= 1:
+			del _shared[i]
+			del _owners[i]
+		else:
+			_owners[i] = n
+
+
+def is_shared(img) -> bool:
+	return _shared.get(id(img)) is img
+
+
+class SimpleLayer:
+	__slots__ = ['image', 'number']
+
+	def __init__(self, image, number):
+		self.image = image
+		self.number = number
+
+	def own(self):
+		"""その場で書き換えてよい画像 (共有していれば複製する)"""
+		if is_shared(self.image):
+			release(self.image)
+			self.image = self.image.copy()
+		return self.image
+
+
+class Document:
+	"""
+	コマンドが書き換えるレイヤーの集まり (画面は持たない)
+	layers: key -> レイヤー (.image, .number と own() を持つもの)
+	order: 下から順のキー (layers[order[n]].number == n)
+	画面に合わせたいときは new_layer, set_number と changed 以下を上書きする
+	"""
+
+	def __init__(self, layers=None):
+		self.layers = {} if layers is None else layers
+		self.order = sorted(self.layers, key=lambda k: self.layers[k].number)
+		self.depth = 0
+
+	def begin(self):
+		"""end までの通知をまとめる (Group が使う)"""
+		self.depth += 1
+
+	def end(self):
+		self.depth -= 1
+		if self.depth == 0:
+			self.flush()
+
+	def new_layer(self, image, number):
+		return SimpleLayer(image, number)
+
+	def set_number(self, lay, number):
+		lay.number = number
+
+	def _renumber(self, start, stop=None):
+		# 順番が変わった範囲だけ付け直す
+		if stop is None:
+			stop = len(self.order)
+		layers = self.layers
+		for n in range(start, stop):
+			lay = layers[self.order[n]]
+			if lay.number != n:
+				self.set_number(lay, n)
+
+	def insert(self, key, number, image):
+		number = max(0, min(len(self.order), number))
+		lay = self.new_layer(image, number)
+		self.layers[key] = lay
+		self.order.insert(number, key)
+		self._renumber(number + 1)
+		self.added(key)
+		return lay
+
+	def remove(self, key):
+		lay = self.layers.pop(key)
+		number = lay.number
+		del self.order[number]
+		self._renumber(number)
+		self.removed(key, lay)
+		return lay
+
+	def move(self, key, number):
+		prev = self.layers[key].number
+		if prev == number:
+			return
+		del self.order[prev]
+		self.order.insert(number, key)
+		self._renumber(min(prev, number), max(prev, number) + 1)
+		self.moved(key)
+
+	def replace(self, key, image):
+		self.layers[key].image = image
+		self.changed(key, None)
+
+	def paste(self, key, box, im):
+		"""box の範囲に im (画像か色) を貼る"""
+		self.layers[key].own().paste(im, box)
+		self.changed(key, box)
+
+	def patch(self, key, box, diff, subtract):
+		"""box の範囲に差分をその場で当てる"""
+		img = self.layers[key].own()
+		region = img.crop(box)
+		if subtract:
+			region = ImageChops.subtract_modulo(region, diff)
+		else:
+			region = ImageChops.add_modulo(region, diff)
+		img.paste(region, box)
+		self.changed(key, box)
+
+	# 変わったことの通知 (画面の更新用)
+	def changed(self, key, box):
+		"""box: 変わった範囲 (None なら画像ごと置き換わった)"""
+
+	def added(self, key):
+		pass
+
+	def removed(self, key, lay):
+		pass
+
+	def moved(self, key):
+		pass
+
+	def flush(self):
+		"""begin から end までに溜めた変更をまとめて画面に出す"""
+
+
+class Command:
+	"""
+	履歴の1項目 apply でやり直し、revert で取り消す
+	画像は .image に持つ (History が圧縮する)
+	"""
+	__slots__ = ['key', 'number', 'box', 'target', 'image']
+	type = None
+	pixel = False  # key のレイヤーの画像だけを変える (History.jump が控えから戻せる)
+
+	def __init__(self, key=None, number=None, box=None, target=None, image=None):
+		self.key = key
+		self.number = number
+		self.box = box
+		self.target = target
+		self.image = image
+
+	def apply(self, doc: Document):
+		raise NotImplementedError
+
+	def revert(self, doc: Document):
+		raise NotImplementedError
+
+
+class PixelDiff(Command):
+	"""image: box の範囲の subtract_modulo(前, 後)"""
+	__slots__ = []
+	type = "sub"
+	pixel = True
+
+	@classmethod
+	def from_images(cls, key, before, after, box=None):
+		"""
+		変化がなければ None
+		box: after が before のこの範囲だけのとき
+		"""
+		if box is None:
+			diff = ImageChops.subtract_modulo(before, after)
+			box = (0, 0, *before.size)
+		else:
+			diff = ImageChops.subtract_modulo(before.crop(box), after)
+		changed = bands_bbox(diff)
+		if changed is None:
+			return None
+		x, y = box[0:2]
+		box = (changed[0] + x, changed[1] + y, changed[2] + x, changed[3] + y)
+		return cls(key, box=box, image=diff.crop(changed))
+
+	def apply(self, doc):
+		doc.patch(self.key, self.box, self.image, True)
+
+	def revert(self, doc):
+		doc.patch(self.key, self.box, self.image, False)
+
+
+class ImageReplace(Command):
+	"""image: (前, 後) レイヤーにはコピーを渡す"""
+	__slots__ = []
+	type = "image"
+	pixel = True
+
+	@classmethod
+	def from_images(cls, key, before, after):
+		same = (
+			before.size == after.size and before.mode == after.mode
+			and bands_bbox(ImageChops.difference(before, after)) is None)
+		if same:
+			return None
+		# after はこの後レイヤーの画像になり、その場で書き換えられるのでコピーを持つ
+		return cls(key, image=(before, after.copy()))
+
+	def apply(self, doc):
+		doc.replace(self.key, self.image[1].copy())
+
+	def revert(self, doc):
+		doc.replace(self.key, self.image[0].copy())
+
+
+class AddLayer(Command):
+	"""
+	number が None (古い履歴) なら一番上に足す
+	画像はコピーせずにレイヤーへ渡し、取り消すときにレイヤーから返してもらう
+	(レイヤーがある間 .image は None)
+	"""
+	__slots__ = []
+	type = "add_layer"
+
+	def apply(self, doc):
+		number = len(doc.order) if self.number is None else self.number
+		doc.insert(self.key, number, self.image)
+		self.image = None
+
+	def revert(self, doc):
+		self.image = doc.remove(self.key).image
+
+
+class RemoveLayer(Command):
+	"""AddLayer の逆 消したレイヤーの画像をそのまま持つ"""
+	__slots__ = []
+	type = "remove_layer"
+
+	def apply(self, doc):
+		self.image = doc.remove(self.key).image
+
+	def revert(self, doc):
+		doc.insert(self.key, self.number, self.image)
+		self.image = None
+
+
+class MoveLayer(Command):
+	"""number から target へ"""
+	__slots__ = []
+	type = "move_layer"
+
+	def apply(self, doc):
+		doc.move(self.key, self.target)
+
+	def revert(self, doc):
+		doc.move(self.key, self.number)
+
+
+def margins(box, size):
+	"""size の画像のうち box の外の4辺 (上, 下, 左, 右) の範囲"""
+	w, h = size
+	x0 = max(0, min(w, box[0]))
+	y0 = max(0, min(h, box[1]))
+	x1 = max(x0, min(w, box[2]))
+	y1 = max(y0, min(h, box[3]))
+	return (
+		(0, 0, w, y0), (0, y1, w, h),
+		(0, y0, x0, y1), (x1, y0, w, y1))
+
+
+class Extent(Command):
+	"""
+	レイヤーの画像を box の範囲に切り抜く (広げた所は透明) リサイズと分割で使う
+	box: 元の画像の座標 target: 元の大きさ
+	image: 切り落とした4辺 (上, 下, 左, 右 空か透明なら None)
+	やり直しは box から作り直すので、結果の画像は持たない
+	"""
+	__slots__ = []
+	type = "extent"
+	pixel = True
+
+	@classmethod
+	def from_image(cls, key, img, box):
+		"""変わらなければ None"""
+		box = tuple(box)
+		if box == (0, 0, *img.size):
+			return None
+		strips = []
+		for m in margins(box, img.size):
+			strip = None
+			if m[0] < m[2] and m[1] < m[3]:
+				strip = img.crop(m)
+				if bands_bbox(strip) is None:
+					strip = None
+			strips.append(strip)
+		return cls(key, box=box, target=img.size, image=tuple(strips))
+
+	def apply(self, doc):
+		doc.replace(self.key, doc.layers[self.key].image.crop(self.box))
+
+	def revert(self, doc):
+		cur = doc.layers[self.key].image
+		x, y = self.box[0:2]
+		w, h = self.target
+		# 残った範囲は今の画像から戻す (box の外は透明になる)
+		img = cur.crop((-x, -y, w - x, h - y))
+		for m, strip in zip(margins(self.box, self.target), self.image):
+			if strip is not None:
+				img.paste(strip, m[0:2])
+		doc.replace(self.key, img)
+
+
+class Clear(Command):
+	"""box の範囲を透明にする image: 消す前の box の範囲"""
+	__slots__ = []
+	type = "clear"
+	pixel = True
+
+	@classmethod
+	def from_image(cls, key, img):
+		"""透明でない範囲だけを消す (何もなければ None)"""
+		box = bands_bbox(img)
+		if box is None:
+			return None
+		return cls(key, box=box, image=img.crop(box))
+
+	def apply(self, doc):
+		doc.paste(self.key, self.box, 0)
+
+	def revert(self, doc):
+		doc.paste(self.key, self.box, self.image)
+
+
+class Group(Command):
+	"""
+	いくつかのコマンドを1回の undo/redo で戻す
+	画面の更新は doc.begin, doc.end で最後に1回にまとめる
+	.image は中のコマンドの .image のタプル (History の圧縮がそのまま使える)
+	"""
+	__slots__ = ['commands']
+	type = "group"
+
+	def __init__(self, commands=None):
+		self.commands = [] if commands is None else list(commands)
+		Command.__init__(self)
+
+	@property
+	def image(self):
+		return tuple(cmd.image for cmd in self.commands)
+
+	@image.setter
+	def image(self, value):
+		if value is None:
+			return
+		for cmd, v in zip(self.commands, value):
+			cmd.image = v
+
+	def apply(self, doc):
+		doc.begin()
+		try:
+			for cmd in self.commands:
+				cmd.apply(doc)
+		finally:
+			doc.end()
+
+	def revert(self, doc):
+		doc.begin()
+		try:
+			for cmd in reversed(self.commands):
+				cmd.revert(doc)
+		finally:
+			doc.end()
+
+
+COMMANDS = {
+	cls.type: cls
+	for cls in (
+		PixelDiff, ImageReplace, AddLayer, RemoveLayer, MoveLayer,
+		Extent, Clear, Group)}
+
+
+def make_command(type: str) -> Command:
+	"""type の名前から空のコマンドを作る (journal の読み込み用)"""
+	return COMMANDS[type]()
@@ -1,22 +1,44 @@
 from PIL import Image
-import io
 import scene
 import ui
 
+from .texenc import ENCODERS, TextureEncoder
 
-__all__ = ["img2ui", "img2tex"]
+
+__all__ = ["img2ui", "img2tex", "set_encoder", "get_default_encoder"]
+
+
+_default = ENCODERS["raw"]
+
+
+def set_encoder(encoder) -> None:
+	"""encoder = str(name) | TextureEncoder"""
+	global _default
+	if not isinstance(encoder, TextureEncoder):
+		encoder = ENCODERS[encoder]
+	_default = encoder
+
+
+def get_default_encoder() -> TextureEncoder:
+	return _default
 
 
 def img2ui(img: Image.Image) -> ui.Image:
-	with io.BytesIO() as f:
-		img.save(f, format="png")
-		buffer_img = f.getvalue()
-	return ui.Image.from_data(buffer_img)
+	return ui.Image.from_data(ENCODERS["png"].encode(img))
 
 
-def img2tex(img: Image.Image) -> scene.Texture:
-	with io.BytesIO() as f:
-		img.save(f, format="bmp")
-		buffer_img = f.getvalue()
-	ui_img = ui.Image.from_data(buffer_img)
+def img2tex(img: Image.Image, encoder: TextureEncoder = None) -> scene.Texture:
+	global _default
+	if encoder is None:
+		encoder = _default
+	try:
+		ui_img = ui.Image.from_data(encoder.encode(img))
+	except ValueError:
+		ui_img = None
+	if ui_img is None and encoder.fallback is not None:
+		# 使えなかったエンコーダーは以降使わない
+		fallback = ENCODERS[encoder.fallback]
+		if encoder is _default:
+			_default = fallback
+		return img2tex(img, fallback)
 	return scene.Texture(ui_img)
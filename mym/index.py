@@ -0,0 +1,126 @@
+import json
+import os
+
+from .indexed import save_png
+from .project import bottom_image, shrink
+
+
+__all__ = [
+	"INDEX", "THUMB", "THUMB_SIZE", "load_index", "save_index", "refresh",
+	"update_project", "copy_project", "remove_project", "rename_project",
+	"thumb_path"]
+
+
+# プロジェクト一覧 (1_select_menu) のための索引
+#	{"projects": {フォルダ名: {"mtime", "layers", "w", "h"}}}
+# mtime は data.json の更新時刻で、変わったプロジェクトだけを作り直す
+# サムネイルはフォルダごとの thumb.png (一番下のレイヤーを縮めたもの)
+
+INDEX = "files/projects_index.json"
+THUMB = "thumb.png"
+THUMB_SIZE = 128
+
+
+def load_index(path: str = INDEX) -> dict:
+	"""読めなければ空の索引 (refresh で全部作り直す)"""
+	try:
+		with open(path) as f:
+			index = json.load(f)
+	except (OSError, ValueError):
+		index = {}
+	index.setdefault("projects", {})
+	return index
+
+
+def save_index(index: dict, path: str = INDEX):
+	tmp = path + ".tmp"
+	with open(tmp, "w") as f:
+		json.dump(index, f, indent=2)
+	os.replace(tmp, path)
+
+
+def thumb_path(folders: str, name: str) -> str:
+	return os.path.join(folders, name, THUMB)
+
+
+def _mtime(folder):
+	return os.path.getmtime(os.path.join(folder, "data.json"))
+
+
+def update_project(index: dict, folders: str, name: str, data: dict = None, image=None):
+	"""
+	name の項目とサムネイルを作り直す
+	data, image: 手元にある data.json と一番下のレイヤー (なければ読む)
+	"""
+	folder = os.path.join(folders, name)
+	if data is None:
+		with open(os.path.join(folder, "data.json")) as f:
+			data = json.load(f)
+	if image is None:
+		image = bottom_image(folder, data)
+	path = thumb_path(folders, name)
+	tmp = path + ".tmp"
+	with open(tmp, "wb") as f:
+		save_png(shrink(image, THUMB_SIZE), f)
+	os.replace(tmp, path)
+	layers = data["layers"].values()
+	entry = {
+		"mtime": _mtime(folder), "layers": len(layers),
+		"w": max(v["w"] for v in layers), "h": max(v["h"] for v in layers)}
+	index["projects"][name] = entry
+	return entry
+
+
+def copy_project(index: dict, folders: str, old: str, new: str):
+	"""
+	copytree (copy2) は thumb.png も mtime もそのまま写すので、項目を写すだけ
+	元の項目がなければ作り直す
+	"""
+	entry = index["projects"].get(old)
+	if entry is None:
+		return update_project(index, folders, new)
+	entry = dict(entry, mtime=_mtime(os.path.join(folders, new)))
+	index["projects"][new] = entry
+	return entry
+
+
+def remove_project(index: dict, name: str):
+	index["projects"].pop(name, None)
+
+
+def rename_project(index: dict, old: str, new: str):
+	"""thumb.png はフォルダごと移るので項目の名前だけ変える"""
+	entry = index["projects"].pop(old, None)
+	if entry is not None:
+		index["projects"][new] = entry
+
+
+def refresh(index: dict, folders: str) -> bool:
+	"""
+	フォルダの一覧と突き合わせる (data.json の mtime が同じなら読まない)
+	変わったかを返す
+	"""
+	projects = index["projects"]
+	names = set()
+	changed = False
+	for name in os.listdir(folders):
+		folder = os.path.join(folders, name)
+		try:
+			mtime = _mtime(folder)
+		except OSError:
+			continue
+		names.add(name)
+		entry = projects.get(name)
+		if entry is not None and entry["mtime"] == mtime and (
+				not entry["layers"] or os.path.exists(thumb_path(folders, name))):
+			continue
+		try:
+			update_project(index, folders, name)
+		except (OSError, ValueError, KeyError):
+			# 壊れたプロジェクトはサムネイルなしで一覧に出す
+			projects[name] = {"mtime": mtime, "layers": 0, "w": 0, "h": 0}
+		changed = True
+	for name in set(projects) - names:
+		del projects[name]
+		changed = True
+	return changed
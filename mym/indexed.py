@@ -0,0 +1,46 @@
+from PIL import Image
+import numpy as np
+
+
+__all__ = ["to_indexed", "save_png"]
+
+
+def to_indexed(img: Image.Image):
+	"""
+	256色以下の RGBA を、同じ画素のパレット画像 ("P") にする (多ければ None)
+	アルファはパレットごとの tRNS (info["transparency"]) に入れる
+	透明な画素の RGB もそのまま残すので、convert("RGBA") で元に戻る
+	"""
+	if img.mode != "RGBA":
+		return None
+	colors = img.getcolors(256)
+	if colors is None:
+		return None
+	w, h = img.size
+	# 1画素 = uint32 (リトルエンディアン前提で 0xAABBGGRR)
+	pixels = np.asarray(img).view(np.uint32).reshape(h, w)
+	entries = np.array([c for _, c in colors], np.uint8)
+	values = entries.view("<u4").ravel()
+	order = np.argsort(values)
+	values = values[order]
+	entries = entries[order]
+	index = np.searchsorted(values, pixels).astype(np.uint8)
+
+	p = Image.frombytes("P", (w, h), index.tobytes())
+	p.putpalette(entries[:, :3].tobytes(), "RGB")
+	# 並びはアルファの小さい順なので、不透明な色は最後にまとまり tRNS を短くできる
+	alpha = entries[:, 3].tobytes().rstrip(b"\xff")
+	if alpha:
+		p.info["transparency"] = alpha
+	return p
+
+
+def save_png(img: Image.Image, fp, indexed: bool = True):
+	"""PNG で書く 256色以下ならパレット画像にする"""
+	p = to_indexed(img) if indexed else None
+	if p is None:
+		img.save(fp, "png")
+	elif "transparency" in p.info:
+		p.save(fp, "png", transparency=p.info["transparency"])
+	else:
+		p.save(fp, "png")
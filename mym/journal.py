@@ -0,0 +1,234 @@
+from PIL import Image
+import json
+import os
+import struct
+
+from .history import Group, PackedImage
+
+
+__all__ = ["Journal"]
+
+
+MAGIC = b"PX3J\x01"
+
+PUSH = 1
+UNDO = 2
+REDO = 3
+SAVED = 4
+BEGIN = 5  # ここから COMMIT までの PUSH は1つの Group
+COMMIT = 6
+
+_RECORD = struct.Struct("<BI")
+_META = struct.Struct("<I")
+
+# 履歴の項目から書き出す属性 (画像は .image)
+FIELDS = ("type", "key", "number", "box", "target")
+
+
+def _encode_image(obj, blobs):
+	if isinstance(obj, PackedImage):
+		blobs.append(obj)
+		return len(blobs) - 1
+	if isinstance(obj, Image.Image):
+		blobs.append(PackedImage(obj))
+		return len(blobs) - 1
+	if isinstance(obj, tuple):
+		return [_encode_image(v, blobs) for v in obj]
+	return None
+
+
+def _decode_image(obj, blobs):
+	if isinstance(obj, int):
+		return blobs[obj]
+	if isinstance(obj, list):
+		return tuple(_decode_image(v, blobs) for v in obj)
+	return None
+
+
+def encode_entry(entry) -> bytes:
+	blobs = []
+	meta = {name: getattr(entry, name) for name in FIELDS}
+	meta["image"] = _encode_image(entry.image, blobs)
+	meta["blobs"] = [(p.mode, *p.size, len(p.data)) for p in blobs]
+	meta = json.dumps(meta).encode()
+	return b"".join([_META.pack(len(meta)), meta] + [p.data for p in blobs])
+
+
+def decode_entry(data: bytes, factory):
+	"""画像は PackedImage のまま (History が取り出すときに戻す)"""
+	n = _META.unpack_from(data)[0]
+	pos = _META.size
+	meta = json.loads(data[pos:pos + n])
+	pos += n
+	blobs = []
+	for mode, w, h, length in meta["blobs"]:
+		blobs.append(PackedImage.from_data(mode, (w, h), data[pos:pos + length]))
+		pos += length
+	entry = factory(meta["type"])
+	for name in FIELDS[1:]:
+		value = meta.get(name)
+		if isinstance(value, list):
+			value = tuple(value)
+		setattr(entry, name, value)
+	entry.image = _decode_image(meta["image"], blobs)
+	return entry
+
+
+class Journal:
+	"""
+	undo 履歴をプロジェクトのフォルダに追記していくファイル
+	PUSH (項目), UNDO, REDO, SAVED (画像と data.json を保存した印) を順に書く
+	Group は BEGIN, 中の PUSH, COMMIT に分けて書く
+	読み込むときは data.json と同じ印までをやり直し、その後ろは捨てる
+	"""
+
+	def __init__(self, path: str, checkpoint: int = 256):
+		self.path = path
+		self.checkpoint = checkpoint
+		self.file = None
+		self.records = 0  # 最後のチェックポイントから書いた数
+		self.mark = 0
+
+	def _open(self):
+		if self.file is None:
+			new = not os.path.exists(self.path)
+			self.file = open(self.path, "ab")
+			if new or self.file.tell() == 0:
+				self.file.write(MAGIC)
+
+	def _write(self, kind, payload=b""):
+		self._open()
+		self.file.write(_RECORD.pack(kind, len(payload)))
+		self.file.write(payload)
+		self.file.flush()
+		self.records += 1
+
+	def push(self, entry):
+		self._write(PUSH, encode_entry(entry))
+
+	def begin(self):
+		self._write(BEGIN)
+
+	def commit(self):
+		self._write(COMMIT)
+
+	def undo(self):
+		self._write(UNDO)
+
+	def redo(self):
+		self._write(REDO)
+
+	def next_mark(self) -> int:
+		"""次の saved で書く印 (先に data.json に残しておく)"""
+		return self.mark + 1
+
+	def saved(self, entries=None, index=-1):
+		"""
+		保存した印を書く
+		記録が checkpoint 件を超えていれば entries, index だけに書き直す
+		"""
+		self.mark += 1
+		if entries is not None and self.records > self.checkpoint:
+			self.rewrite(entries, index)
+		else:
+			self._write(SAVED, struct.pack("<Q", self.mark))
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def _read(self):
+		"""(kind, payload, 終わりの位置) 途中で切れた記録は読まない"""
+		try:
+			with open(self.path, "rb") as f:
+				data = f.read()
+		except FileNotFoundError:
+			return
+		if not data.startswith(MAGIC):
+			return
+		pos = len(MAGIC)
+		while pos + _RECORD.size <= len(data):
+			kind, length = _RECORD.unpack_from(data, pos)
+			start = pos + _RECORD.size
+			end = start + length
+			if end > len(data):
+				break
+			yield kind, data[start:end], end
+			pos = end
+
+	def load(self, mark, factory):
+		"""
+		印 mark の時点の (entries, index) を返す
+		見つからなければ履歴を捨てて ([], -1)
+		"""
+		entries = []
+		index = -1
+		found = None
+		payloads = []
+		self.mark = 0
+		for kind, payload, end in self._read():
+			if kind == SAVED:
+				m = struct.unpack("<Q", payload)[0]
+				self.mark = max(self.mark, m)
+				if m == mark:
+					found = (len(payloads), end)
+			payloads.append((kind, payload))
+
+		if mark is None or found is None:
+			self.rewrite([], -1)
+			return entries, index
+
+		count, end = found
+		group = None
+		for kind, payload in payloads[:count]:
+			if kind == PUSH and group is not None:
+				group.commands.append(decode_entry(payload, factory))
+			elif kind == BEGIN:
+				group = Group()
+			elif kind == COMMIT or kind == PUSH:
+				if kind == PUSH:
+					entry = decode_entry(payload, factory)
+				else:
+					entry, group = group, None
+					if not entry.commands:
+						continue
+				del entries[index + 1:]
+				entries.append(entry)
+				index += 1
+			elif kind == UNDO:
+				index -= 1
+			elif kind == REDO:
+				index += 1
+		self.mark = mark
+		# 印より後ろ (保存されなかった操作) は捨てる
+		with open(self.path, "r+b") as f:
+			f.truncate(end)
+		self.records = count
+		return entries, index
+
+	def rewrite(self, entries, index):
+		"""今の履歴だけを書き直す (チェックポイント)"""
+		self.close()
+		tmp = self.path + ".tmp"
+		with open(tmp, "wb") as f:
+			f.write(MAGIC)
+			for entry in entries:
+				if isinstance(entry, Group):
+					f.write(_RECORD.pack(BEGIN, 0))
+					children = entry.commands
+				else:
+					children = [entry]
+				for child in children:
+					payload = encode_entry(child)
+					f.write(_RECORD.pack(PUSH, len(payload)))
+					f.write(payload)
+				if isinstance(entry, Group):
+					f.write(_RECORD.pack(COMMIT, 0))
+			for _ in range(len(entries) - 1 - index):
+				f.write(_RECORD.pack(UNDO, 0))
+			payload = struct.pack("<Q", self.mark)
+			f.write(_RECORD.pack(SAVED, len(payload)))
+			f.write(payload)
+		os.replace(tmp, self.path)
+		self.records = 0
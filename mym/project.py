@@ -0,0 +1,171 @@
+from PIL import Image
+import json
+import os
+import threading
+
+from .indexed import save_png
+
+
+__all__ = [
+	"LAYER_DIR", "STACKED", "LazyImage", "layer_file", "bottom_layer",
+	"load_layers",
+	"bottom_image", "shrink", "write_project", "remove_unused"]
+
+
+# レイヤーごとの画像を置くフォルダ (data.json の "file" はここからの相対パス)
+LAYER_DIR = "layers"
+# 古い形式: 全部のレイヤーを縦に並べた1枚 (data.json の "y" が位置)
+STACKED = "layers.png"
+
+
+def layer_file(key, number) -> str:
+	"""
+	number: 何回目の保存か
+	保存ごとに名前を変えるので、data.json を置き換えるまでは前のファイルが残る
+	"""
+	return f"{LAYER_DIR}/{key}_{number}.png"
+
+
+def bottom_layer(data):
+	"""一番下のレイヤー ("n" がない古いデータはキーが順番)"""
+	for k, lay_dict in data["layers"].items():
+		if lay_dict.get("n", int(k)) == 0:
+			return lay_dict
+	return next(iter(data["layers"].values()))
+
+
+def _open(path):
+	with Image.open(path) as img:
+		return img.convert("RGBA")
+
+
+class _Stacked:
+	"""古い形式の layers.png (最初に切り出すときに1回だけ読む)"""
+
+	def __init__(self, path):
+		self.path = path
+		self.image = None
+		self.lock = threading.Lock()
+
+	def crop(self, box):
+		with self.lock:
+			if self.image is None:
+				self.image = _open(self.path)
+			return self.image.crop(box)
+
+
+class LazyImage:
+	"""
+	まだ読んでいないレイヤーの画像 open() で PIL.Image を作る (何度でも同じ画像)
+	size は data.json の値なので読まなくてもわかる
+	path も stacked もなければ透明な画像 (ファイルが消えていれば open で例外)
+	"""
+	__slots__ = ['size', 'path', 'stacked', 'box']
+
+	def __init__(self, size, path=None, stacked=None, box=None):
+		self.size = tuple(size)
+		self.path = path
+		self.stacked = stacked
+		self.box = box
+
+	def open(self) -> Image.Image:
+		if self.path is not None:
+			return _open(self.path)
+		if self.stacked is not None:
+			return self.stacked.crop(self.box)
+		return Image.new("RGBA", self.size, (0, 0, 0, 0))
+
+
+def _lazy(folder, lay_dict, stacked):
+	"""(LazyImage, ファイルがあるか)"""
+	size = (lay_dict["w"], lay_dict["h"])
+	if "file" in lay_dict:
+		path = os.path.join(folder, lay_dict["file"])
+		if not os.path.exists(path):
+			return LazyImage(size), False
+		return LazyImage(size, path=path), True
+	if stacked is None:
+		return LazyImage(size), False
+	y = lay_dict["y"]
+	box = (0, y, size[0], y + size[1])
+	return LazyImage(size, stacked=stacked, box=box), True
+
+
+def load_layers(folder: str, data: dict, lazy: bool = False):
+	"""
+	{キー: 画像} と、見つからなかった数を返す
+	lazy なら画像の代わりに LazyImage を返す (ファイルがあるかだけを見る)
+	見つからないレイヤーは w x h の透明な画像にする
+	"""
+	stacked = None
+	path = os.path.join(folder, STACKED)
+	if any("file" not in v for v in data["layers"].values()) and os.path.exists(path):
+		stacked = _Stacked(path)
+	images = {}
+	missing = 0
+	for k, lay_dict in data["layers"].items():
+		img, found = _lazy(folder, lay_dict, stacked)
+		if not found:
+			missing += 1
+		images[int(k)] = img if lazy else img.open()
+	return images, missing
+
+
+def bottom_image(folder: str, data: dict):
+	"""一番下のレイヤーの画像だけを読む (プロジェクト一覧のサムネイル用)"""
+	lay_dict = bottom_layer(data)
+	stacked = None
+	path = os.path.join(folder, STACKED)
+	if "file" not in lay_dict and os.path.exists(path):
+		stacked = _Stacked(path)
+	return _lazy(folder, lay_dict, stacked)[0].open()
+
+
+def shrink(img: Image.Image, size: int) -> Image.Image:
+	"""長い辺が size px になるように最近傍で拡大縮小する"""
+	w, h = img.size
+	scale = size / max(w, h)
+	if scale >= 1:
+		# ドット絵なので整数倍にとどめる
+		scale = int(scale)
+	tw = max(1, round(w * scale))
+	th = max(1, round(h * scale))
+	if (tw, th) == (w, h):
+		return img
+	return img.resize((tw, th), Image.NEAREST)
+
+
+def _replace(path, write):
+	"""一時ファイルに書いてから置き換える (途中で止まっても元のファイルは壊れない)"""
+	tmp = path + ".tmp"
+	with open(tmp, "wb") as f:
+		write(f)
+	os.replace(tmp, path)
+
+
+def write_project(folder: str, images: dict, data: dict):
+	"""
+	images: {ファイル名: 画像} を書いてから data.json を置き換え、
+	(256色以下のレイヤーはパレット画像の PNG になる)
+	data.json から使われなくなったレイヤーの画像を消す
+	"""
+	os.makedirs(os.path.join(folder, LAYER_DIR), exist_ok=True)
+	for name, img in images.items():
+		_replace(os.path.join(folder, name), lambda f: save_png(img, f))
+	text = json.dumps(data, indent=2).encode()
+	_replace(os.path.join(folder, "data.json"), lambda f: f.write(text))
+	remove_unused(folder, [v["file"] for v in data["layers"].values()])
+
+
+def remove_unused(folder: str, files):
+	"""files 以外のレイヤーの画像と、移行済みの layers.png を消す"""
+	names = {os.path.basename(name) for name in files}
+	path = os.path.join(folder, LAYER_DIR)
+	if os.path.isdir(path):
+		for name in os.listdir(path):
+			if name.endswith(".png") and name not in names:
+				os.remove(os.path.join(path, name))
+	try:
+		os.remove(os.path.join(folder, STACKED))
+	except FileNotFoundError:
+		pass
@@ -0,0 +1,91 @@
+from PIL import Image, ImageFile
+import io
+import struct
+
+
+__all__ = [
+	"TextureEncoder", "PNGEncoder", "BMPEncoder", "RawEncoder",
+	"ENCODERS", "get_encoder"]
+
+
+class TextureEncoder:
+	"""
+	PIL.Image -> ui.Image.from_data() に渡せるバイト列
+	premultiplied = True のエンコーダーはアルファ乗算済みの画像を受け取る
+	"""
+	name = None
+	premultiplied = False
+	fallback = None
+
+	def encode(self, img: Image.Image) -> bytes:
+		raise NotImplementedError
+
+
+class PNGEncoder(TextureEncoder):
+	name = "png"
+
+	def encode(self, img: Image.Image) -> bytes:
+		with io.BytesIO() as f:
+			img.save(f, format="png")
+			return f.getvalue()
+
+
+class BMPEncoder(TextureEncoder):
+	name = "bmp"
+	premultiplied = True
+
+	def encode(self, img: Image.Image) -> bytes:
+		with io.BytesIO() as f:
+			img.save(f, format="bmp")
+			return f.getvalue()
+
+
+class RawEncoder(TextureEncoder):
+	"""
+	PILのBMPプラグインを通さずに 32bit BMP を組み立てる
+	ヘッダーはサイズごとにキャッシュし、書き込み先のバッファは使い回す
+	"""
+	name = "raw"
+	premultiplied = True
+	fallback = "bmp"
+
+	def __init__(self):
+		self._headers = {}
+		self._buffer = io.BytesIO()
+
+	def header(self, size):
+		try:
+			return self._headers[size]
+		except KeyError:
+			pass
+		w, h = size
+		image = w * h * 4
+		ppm = 3780  # 96dpi (PIL と同じ値)
+		header = (
+			b"BM" + struct.pack("<III", 54 + image, 0, 54)
+			+ struct.pack(
+				"<IiiHHIIiiII", 40, w, h, 1, 32, 0, image, ppm, ppm, 0, 0))
+		self._headers[size] = header
+		return header
+
+	def encode(self, img: Image.Image) -> bytes:
+		if img.mode != "RGBA":
+			raise ValueError(f"cannot encode mode {img.mode} as raw texture")
+		f = self._buffer
+		f.seek(0)
+		f.truncate()
+		f.write(self.header(img.size))
+		# 下から上へ BGRA の順 (BMPの並び)
+		ImageFile._save(img, f, [("raw", (0, 0) + img.size, 0, ("BGRA", 0, -1))])
+		return f.getvalue()
+
+
+ENCODERS = {
+	"png": PNGEncoder(),
+	"bmp": BMPEncoder(),
+	"raw": RawEncoder(),
+}
+
+
+def get_encoder(name: str) -> TextureEncoder:
+	return ENCODERS[name]
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import queue
+import threading
+
+from .img2tex import img2ui
+from .project import shrink
+
+
+__all__ = ["Thumbnailer"]
+
+
+class Thumbnailer:
+	"""
+	レイヤーのプレビュー画像を別スレッドで作る
+	(version, size) ごとにキャッシュするので、変わっていないレイヤーは作り直さない
+	"""
+	def __init__(self, limit=256):
+		self.limit = limit
+		self._cache = OrderedDict()
+		self._targets = {}
+		self._lock = threading.Lock()
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def get(self, lay, size):
+		key = (lay.version, size)
+		with self._lock:
+			ui_img = self._cache.get(key)
+			if ui_img is not None:
+				self._cache.move_to_end(key)
+		return ui_img
+
+	def request(self, lay, size, callback):
+		"""キャッシュがあればその場で、なければ作ってから callback(ui.Image)"""
+		ui_img = self.get(lay, size)
+		if ui_img is not None:
+			callback(ui_img)
+		else:
+			self._queue.put((lay, lay.version, size, callback))
+
+	def show(self, view, lay, size):
+		"""view.image に表示する 後から頼んだ方が優先される"""
+		key = (lay.version, size)
+		with self._lock:
+			self._targets[view] = key
+
+		def callback(ui_img):
+			with self._lock:
+				if self._targets.get(view) != key:
+					return
+				del self._targets[view]
+			view.image = ui_img
+		self.request(lay, size, callback)
+
+	def forget(self, view):
+		with self._lock:
+			self._targets.pop(view, None)
+
+	def stop(self):
+		"""スレッドを終える (それまでに頼まれた分は作る)"""
+		self._queue.put(None)
+
+	def _run(self):
+		while True:
+			job = self._queue.get()
+			if job is None:
+				return
+			lay, version, size, callback = job
+			# 頼まれた後に書き換えられたものは、新しい方の依頼に任せる
+			if lay.version != version:
+				continue
+			ui_img = self.get(lay, size)
+			if ui_img is None:
+				ui_img = img2ui(shrink(lay.image, size))
+				if lay.version != version:
+					continue
+				with self._lock:
+					self._cache[(version, size)] = ui_img
+					while len(self._cache) > self.limit:
+						self._cache.popitem(last=False)
+			callback(ui_img)
@@ -0,0 +1,24 @@
+from PIL import Image
+
+import pytest
+
+from mym.history import PixelDiff
+
+
+def _dot(doc, history, key, i, box=None):
+	"""
+	key のレイヤーに1点打つ (box がなければ i から決める)
+	控えを取ってから push し、その後で書き換える (控えが書き換え前の画像になる順)
+	"""
+	region = Image.new("RGBA", (1, 1), (i % 255 + 1, 0, 0, 255))
+	if box is None:
+		box = (i % 16, i // 16 % 16, i % 16 + 1, i // 16 % 16 + 1)
+	cmd = PixelDiff.from_images(key, doc.layers[key].image, region, box)
+	history.keyframe(doc)
+	history.push(cmd)
+	doc.layers[key].own().paste(region, box)
+
+
+@pytest.fixture
+def dot():
+	return _dot
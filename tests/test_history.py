@@ -0,0 +1,277 @@
+from PIL import Image
+
+import pytest
+
+from mym.history import (
+	AddLayer, Clear, Document, Extent, Group, History, ImageReplace,
+	MoveLayer, PixelDiff, RemoveLayer, is_shared, release, share)
+
+
+def blank(size=16, color=(0, 0, 0, 0)):
+	return Image.new("RGBA", (size, size), color)
+
+
+def state(doc):
+	"""下から順の (キー, 大きさ, 画素)"""
+	for n, key in enumerate(doc.order):
+		assert doc.layers[key].number == n
+	return [
+		(key, doc.layers[key].image.size, doc.layers[key].image.tobytes())
+		for key in doc.order]
+
+
+def document():
+	doc = Document()
+	for key, color in enumerate([(255, 0, 0, 255), (0, 255, 0, 128), (0, 0, 255, 255)]):
+		img = blank()
+		img.paste(color, (key * 4, key * 4, key * 4 + 6, key * 4 + 6))
+		doc.insert(key, key, img)
+	return doc
+
+
+def check(doc, cmd, expect):
+	"""apply で expect になり、revert で元に戻り、もう一度 apply できる"""
+	before = state(doc)
+	cmd.apply(doc)
+	after = state(doc)
+	expect(before, after)
+	cmd.revert(doc)
+	assert state(doc) == before
+	cmd.apply(doc)
+	assert state(doc) == after
+
+
+def test_pixel_diff():
+	doc = document()
+	img = doc.layers[1].image
+	region = Image.new("RGBA", (3, 2), (9, 9, 9, 255))
+	box = (2, 3, 5, 5)
+	cmd = PixelDiff.from_images(1, img, region, box)
+	assert cmd.box == box
+	assert PixelDiff.from_images(1, img, img.crop(box), box) is None
+
+	def expect(before, after):
+		img = doc.layers[1].image
+		assert img.crop(box).tobytes() == region.tobytes()
+		assert [a[0] for a in after] == [0, 1, 2]
+		assert after[0] == before[0] and after[2] == before[2]
+	check(doc, cmd, expect)
+
+
+def test_image_replace():
+	doc = document()
+	new = blank(8, (1, 2, 3, 4))
+	cmd = ImageReplace.from_images(2, doc.layers[2].image, new)
+	assert ImageReplace.from_images(2, new, new.copy()) is None
+
+	def expect(before, after):
+		assert after[2] == (2, (8, 8), new.tobytes())
+		assert after[:2] == before[:2]
+	check(doc, cmd, expect)
+
+
+def test_add_layer():
+	doc = document()
+	new = blank(16, (5, 5, 5, 255))
+	data = new.tobytes()
+	cmd = AddLayer(3, 1, image=new)
+
+	def expect(before, after):
+		assert [a[0] for a in after] == [0, 3, 1, 2]
+		assert after[1][2] == data
+		assert cmd.image is None
+	check(doc, cmd, expect)
+
+
+def test_add_layer_on_top_without_number():
+	doc = document()
+	cmd = AddLayer(3, None, image=blank())
+
+	def expect(before, after):
+		assert [a[0] for a in after] == [0, 1, 2, 3]
+	check(doc, cmd, expect)
+
+
+def test_remove_layer():
+	doc = document()
+	lay = doc.layers[1]
+	cmd = RemoveLayer(1, lay.number, image=lay.image)
+
+	def expect(before, after):
+		assert after == [before[0], before[2]]
+	check(doc, cmd, expect)
+
+
+@pytest.mark.parametrize("number, target, order", [
+	(0, 2, [1, 2, 0]), (2, 0, [2, 0, 1]), (1, 2, [0, 2, 1])])
+def test_move_layer(number, target, order):
+	doc = document()
+	key = doc.order[number]
+	cmd = MoveLayer(key, number, target=target)
+
+	def expect(before, after):
+		assert [a[0] for a in after] == order
+		assert sorted(after) == sorted(before)
+	check(doc, cmd, expect)
+
+
+@pytest.mark.parametrize("box", [
+	(2, 3, 10, 12), (-4, -2, 20, 16), (4, -4, 12, 24)])
+def test_extent(box):
+	doc = document()
+	img = doc.layers[0].image.copy()
+	cmd = Extent.from_image(0, img, box)
+	assert Extent.from_image(0, img, (0, 0, 16, 16)) is None
+
+	def expect(before, after):
+		assert after[0][1:] == (
+			(box[2] - box[0], box[3] - box[1]), img.crop(box).tobytes())
+		assert after[1:] == before[1:]
+	check(doc, cmd, expect)
+
+
+def test_clear():
+	doc = document()
+	img = doc.layers[2].image
+	cmd = Clear.from_image(2, img)
+	assert cmd.box == (8, 8, 14, 14)
+	assert Clear.from_image(2, blank()) is None
+
+	def expect(before, after):
+		assert after[2] == (2, (16, 16), blank().tobytes())
+		assert after[:2] == before[:2]
+	check(doc, cmd, expect)
+
+
+def test_group():
+	doc = document()
+	added = blank(16, (7, 7, 7, 255))
+	cmds = [
+		AddLayer(3, 3, image=added),
+		MoveLayer(0, 0, target=2),
+		Clear.from_image(1, doc.layers[1].image)]
+	group = Group(cmds)
+	ends = []
+	doc.flush = lambda: ends.append(len(ends))
+
+	def expect(before, after):
+		assert [a[0] for a in after] == [1, 2, 0, 3]
+		assert after[0][2] == blank().tobytes()
+		assert after[3][2] == added.tobytes()
+	check(doc, group, expect)
+	# 画面の更新は apply, revert ごとに1回
+	assert len(ends) == 3
+	assert len(group.image) == 3
+
+
+def test_keyframes_count_toward_budget(dot):
+	doc = Document()
+	doc.insert(0, 0, blank(64))
+	history = History(interval=4)
+	for i in range(20):
+		dot(doc, history, 0, i)
+	assert history.keyframes
+	layer = 64 * 64 * 4
+	assert history.nbytes >= layer * len(history.keyframes)
+
+	small = History(budget=layer, interval=4)
+	doc = Document()
+	doc.insert(0, 0, blank(64))
+	for i in range(20):
+		dot(doc, small, 0, i)
+		assert small.nbytes <= layer
+	assert len(small.entries) == 20
+	# 入らない控えは作らず、画像も共有にしない
+	assert not small.keyframes
+	assert not is_shared(doc.layers[0].image)
+
+
+class LazyLayer:
+	"""draw.py の Layer のように、開くまで .lazy を持つレイヤー"""
+
+	def __init__(self, image, number):
+		self.lazy = image
+		self._image = None
+		self.number = number
+
+	@property
+	def image(self):
+		if self.lazy is not None:
+			self._image, self.lazy = self.lazy, None
+		return self._image
+
+	@image.setter
+	def image(self, img):
+		self._image = img
+		self.lazy = None
+
+	def own(self):
+		if is_shared(self.image):
+			self._image = self._image.copy()
+		return self._image
+
+
+def test_keyframe_leaves_unopened_layers_closed(dot):
+	doc = Document()
+	doc.new_layer = LazyLayer
+	doc.insert(0, 0, blank())
+	doc.insert(1, 1, blank())
+	history = History(interval=4)
+	doc.layers[0].image
+	history.keyframe(doc)
+	assert doc.layers[1].lazy is not None
+	assert list(history.keyframes[0][1]) == [0]
+
+	# 控えにないレイヤーを変えた範囲は、控えを使わずにやり直す
+	states = [state(doc)]
+	for i in range(12):
+		dot(doc, history, i % 2, i)
+		states.append(state(doc))
+	for target in (-1, 11, 3, 7, -1):
+		history.jump(doc, target)
+		assert state(doc) == states[target + 1]
+
+
+def test_share_copies_once():
+	doc = Document()
+	doc.insert(0, 0, blank())
+	img = doc.layers[0].image
+	doc.insert(1, 1, share(img))
+
+	# 先に書いた方だけが複製し、残った方はそのまま書き換える
+	first = doc.layers[1].own()
+	assert first is not img
+	assert not is_shared(img)
+	assert doc.layers[0].own() is img
+
+
+def test_share_counts_every_owner():
+	img = blank()
+	share(img)
+	share(img)
+	release(img)
+	assert is_shared(img)
+	release(img)
+	assert not is_shared(img)
+	release(img)
+	assert not is_shared(img)
+
+
+def test_writes_after_jump_keep_keyframe(dot):
+	doc = Document()
+	doc.insert(0, 0, blank())
+	history = History(interval=4)
+	states = [state(doc)]
+	for i in range(10):
+		dot(doc, history, 0, i)
+		states.append(state(doc))
+	frozen = [
+		(index, img, img.tobytes())
+		for index, images in history.keyframes for img in images.values()]
+	history.jump(doc, -1)
+	assert state(doc) == states[0]
+	assert any(doc.layers[0].image is img for _, img, _ in frozen)
+	# 控えから戻した画像に書いても、控えは変わらない
+	doc.paste(0, (15, 15, 16, 16), (1, 2, 3, 255))
+	for index, img, data in frozen:
+		assert img.tobytes() == data
@@ -0,0 +1,22 @@
+from PIL import Image
+import os
+import shutil
+
+from mym.index import copy_project, load_index, refresh, thumb_path
+from mym.project import layer_file, write_project
+
+
+def test_copy_reuses_entry_and_thumbnail(tmp_path):
+	folders = str(tmp_path / "save_data")
+	name = layer_file(0, 1)
+	data = {"layers": {"0": {"w": 4, "h": 4, "a": 1.0, "n": 0, "file": name}}}
+	write_project(os.path.join(folders, "a"), {name: Image.new("RGBA", (4, 4), (1, 2, 3, 255))}, data)
+	index = load_index(str(tmp_path / "index.json"))
+	assert refresh(index, folders)
+
+	shutil.copytree(os.path.join(folders, "a"), os.path.join(folders, "b"))
+	copy_project(index, folders, "a", "b")
+	assert index["projects"]["b"] == index["projects"]["a"]
+	assert os.path.exists(thumb_path(folders, "b"))
+	# 写した項目のままで、作り直すものはない
+	assert not refresh(index, folders)
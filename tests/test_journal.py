@@ -0,0 +1,52 @@
+from PIL import Image
+import random
+
+from mym.history import Document, History, make_command
+from mym.journal import Journal
+
+
+def edits(dot, doc, history, n, rnd):
+	for i in range(n):
+		key = rnd.choice(doc.order)
+		x, y = rnd.randrange(16), rnd.randrange(16)
+		dot(doc, history, key, i, (x, y, x + 1, y + 1))
+
+
+def test_jump_through_keyframe_keeps_journal_index(tmp_path, dot):
+	path = str(tmp_path / "history.journal")
+	journal = Journal(path)
+	doc = Document()
+	for key in range(2):
+		doc.insert(key, key, Image.new("RGBA", (16, 16), (0, 0, 0, 0)))
+	history = History(journal=journal, interval=8)
+	edits(dot, doc, history, 40, random.Random(0))
+	assert history.keyframes
+
+	history.jump(doc, 20)
+	assert history.index == 20
+	journal.saved()
+	journal.close()
+
+	entries, index = Journal(path).load(journal.mark, make_command)
+	assert len(entries) == 40
+	assert index == 20
+
+
+def test_group_survives_reload(tmp_path, dot):
+	path = str(tmp_path / "history.journal")
+	journal = Journal(path)
+	doc = Document()
+	doc.insert(0, 0, Image.new("RGBA", (16, 16), (0, 0, 0, 0)))
+	history = History(journal=journal)
+	history.begin()
+	edits(dot, doc, history, 3, random.Random(1))
+	history.commit()
+	edits(dot, doc, history, 2, random.Random(2))
+	history.undo()
+	journal.saved()
+	journal.close()
+
+	entries, index = Journal(path).load(journal.mark, make_command)
+	assert [entry.type for entry in entries] == ["group", "sub", "sub"]
+	assert len(entries[0].commands) == 3
+	assert index == 1
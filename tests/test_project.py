@@ -0,0 +1,32 @@
+from PIL import Image
+import os
+
+import pytest
+
+from mym.project import layer_file, load_layers, write_project
+
+
+def project(folder):
+	data = {"layers": {"0": {"w": 4, "h": 4, "a": 1.0, "n": 0}}}
+	name = layer_file(0, 1)
+	data["layers"]["0"]["file"] = name
+	img = Image.new("RGBA", (4, 4), (255, 0, 0, 255))
+	write_project(folder, {name: img}, data)
+	return data, os.path.join(folder, name)
+
+
+def test_lazy_layer_missing_at_load_is_blank(tmp_path):
+	data, path = project(str(tmp_path))
+	os.remove(path)
+	images, missing = load_layers(str(tmp_path), data, lazy=True)
+	assert missing == 1
+	assert images[0].open().getbbox() is None
+
+
+def test_lazy_layer_removed_after_load_raises(tmp_path):
+	data, path = project(str(tmp_path))
+	images, missing = load_layers(str(tmp_path), data, lazy=True)
+	assert missing == 0
+	os.remove(path)
+	with pytest.raises(FileNotFoundError):
+		images[0].open()